@@ -0,0 +1,255 @@
+"""
+HMM Benchmarks
+
+Trains a model on each bundled corpus and measures, for every decoder
+mode, how long training, model loading and decoding take, the decoding
+throughput in sentences and tokens per second, the latency of single
+sentences by length, the peak memory and the error rate:
+
+    ptb  ptb.2-21 -> ptb.22
+    btb  btb.train -> btb.test
+    jv   jv.train -> jv.test
+
+Each measurement runs in a fresh process, so peak memory is its own and
+no caches carry over. The sentence cache is disabled while decoding.
+Throughput is the best of --repeat runs, and so is the latency of each
+sentence before it goes into the mean and 95th percentile of its length
+bucket, so that neither is gated on a single noisy run.
+
+Usage: python bench_hmm.py [--corpora NAME ...] [--modes MODE ...] [--repeat N]
+                           [--output FILE] [--baseline FILE [--tolerance T]]
+
+Results are written as JSON to FILE (bench.json by default). With
+--baseline, every metric is compared against the same metric in an
+earlier results file and those that got worse by more than the
+tolerance (a fraction, 0.1 by default) are listed; the exit status is 1
+if there are any. Metrics ending in _per_s are better higher, and
+times, memory and error rates better lower; counts, such as the
+sentences in a latency bucket, are not compared.
+
+Requires NumPy.
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import tag_acc
+import train_hmm
+import viterbi
+
+DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Training tags and text, then development text and gold tags
+CORPORA = {
+    "ptb": ("ptb.2-21.tgs", "ptb.2-21.txt", "ptb.22.txt", "ptb.22.tgs"),
+    "btb": ("btb.train.tgs", "btb.train.txt", "btb.test.txt", "btb.test.tgs"),
+    "jv": ("jv.train.tgs", "jv.train.txt", "jv.test.txt", "jv.test.tgs"),
+}
+
+BEAM = 8   # beam width of the beam modes
+
+# Decoder settings of each mode: (trigram, beam, batch_size)
+MODES = {
+    "bigram": (False, None, None),
+    "trigram": (True, None, None),
+    "bigram-beam": (False, BEAM, None),
+    "trigram-beam": (True, BEAM, None),
+    "bigram-batch": (False, None, viterbi.BATCH_SIZE),
+    "trigram-batch": (True, None, viterbi.BATCH_SIZE),
+}
+
+# Upper ends of the sentence length buckets latency is reported by
+LENGTH_BUCKETS = (10, 20, 40)
+TOLERANCE = 0.1
+
+# Name endings of the metrics compared against a baseline, and whether
+#   higher is better; the first that matches counts
+COMPARED_METRICS = (("_per_s", True), ("_s", False), ("_ms", False), ("_mb", False), ("_error", False))
+
+def data_path(name):
+    return os.path.join(DATA_DIR, name)
+
+# ru_maxrss is in kilobytes on Linux
+def peak_memory_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Run a measurement in a fresh process and return its result
+def measure(task, *args):
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(task, args)
+
+# Task: train a text model and compile it
+def run_train(corpus, model_path, compiled_path):
+    (tag_file, token_file) = CORPORA[corpus][:2]
+    t0 = time.perf_counter()
+    with open(data_path(tag_file)) as tags, open(data_path(token_file)) as tokens:
+        counts = train_hmm.count_corpus(tags, tokens)
+    train_hmm.write_model(counts, model_path)
+    t1 = time.perf_counter()
+    viterbi.load_model(model_path)
+    viterbi.save_compiled_model(compiled_path)
+    t2 = time.perf_counter()
+    return {"train_s": t1 - t0, "compile_s": t2 - t1, "peak_mb": peak_memory_mb()}
+
+# Task: time loading a model file
+def run_load(model_path):
+    t0 = time.perf_counter()
+    viterbi.load_model(model_path)
+    return {"load_s": time.perf_counter() - t0, "peak_mb": peak_memory_mb()}
+
+# Mean and 95th percentile latency of single sentences, by length bucket
+# Each sentence's latency is the fastest of repeat runs, as throughput is
+def latency_by_length(lines, trigram, beam, repeat):
+    latencies = {}
+    for line in lines:
+        times = []
+        for i in range(repeat):
+            t0 = time.perf_counter()
+            viterbi.viterbi([line], trigram, beam)
+            times.append(time.perf_counter() - t0)
+        elapsed = min(times) * 1000
+        length = len(line.split())
+        bucket = next(("{}-{}".format(low + 1, high)
+            for (low, high) in zip((0,) + LENGTH_BUCKETS, LENGTH_BUCKETS) if length <= high),
+            "{}+".format(LENGTH_BUCKETS[-1] + 1))
+        latencies.setdefault(bucket, []).append(elapsed)
+    return {bucket: {"sentences": len(times), "mean_ms": float(np.mean(times)),
+        "p95_ms": float(np.percentile(times, 95))} for (bucket, times) in latencies.items()}
+
+# Task: decode the development text in one mode
+def run_decode(corpus, mode, model_path, repeat):
+    (text_file, gold_file) = CORPORA[corpus][2:]
+    (trigram, beam, batch_size) = MODES[mode]
+    with open(data_path(text_file)) as f:
+        lines = f.readlines()
+    with open(data_path(gold_file)) as f:
+        gold = f.readlines()
+
+    viterbi.load_model(model_path)
+    viterbi.sentence_cache_size = 0
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        results = viterbi.viterbi_chunk(lines, trigram, beam, batch_size)[0]
+        times.append(time.perf_counter() - t0)
+    decode_s = min(times)
+
+    result = tag_acc.score_lines(gold, [results])[0]
+    measurements = {
+        "decode_s": decode_s,
+        "sentences_per_s": len(lines) / decode_s,
+        "tokens_per_s": sum(len(line.split()) for line in lines) / decode_s,
+        "word_error": tag_acc.rate(result["token_errors"], result["tokens"]),
+        "sentence_error": tag_acc.rate(result["sentence_errors"], result["sentences"]),
+    }
+    # Batch modes have no single-sentence latency of their own
+    if batch_size is None:
+        measurements["latency"] = latency_by_length(lines, trigram, beam, repeat)
+    measurements["peak_mb"] = peak_memory_mb()
+    return measurements
+
+def run_benchmarks(args):
+    results = {}
+    with tempfile.TemporaryDirectory() as model_dir:
+        for corpus in args.corpora:
+            model_path = os.path.join(model_dir, corpus + ".hmm")
+            compiled_path = os.path.join(model_dir, corpus + ".hmmc")
+            print("{}: training".format(corpus), file=sys.stderr)
+            results[corpus] = {
+                "train": measure(run_train, corpus, model_path, compiled_path),
+                "load": measure(run_load, model_path),
+                "load_compiled": measure(run_load, compiled_path),
+                "decode": {},
+            }
+            for mode in args.modes:
+                print("{}: decoding with {}".format(corpus, mode), file=sys.stderr)
+                results[corpus]["decode"][mode] = measure(run_decode, corpus, mode, compiled_path, args.repeat)
+    return results
+
+# Flatten nested results into {"corpus/.../metric": value}
+def flatten(results, prefix=""):
+    metrics = {}
+    for (key, value) in results.items():
+        if isinstance(value, dict):
+            metrics.update(flatten(value, prefix + key + "/"))
+        else:
+            metrics[prefix + key] = value
+    return metrics
+
+# Print how each metric changed against a baseline and return the metrics
+#   that got worse by more than the tolerance
+def compare(results, baseline, tolerance):
+    current = flatten(results)
+    previous = flatten(baseline)
+    regressions = []
+    print("{:<48} {:>12} {:>12} {:>8}".format("metric", "baseline", "current", "change"))
+    for name in sorted(set(current) & set(previous)):
+        higher_better = next((higher for (ending, higher) in COMPARED_METRICS if name.endswith(ending)), None)
+        if higher_better is None:
+            continue
+        (old, new) = (previous[name], current[name])
+        change = (new - old) / old if old else (0.0 if new == old else float("inf"))
+        worse = -change if higher_better else change
+        flag = ""
+        if worse > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<48} {:>12.4g} {:>12.4g} {:>+7.1%}{}".format(name, old, new, change, flag))
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark HMM training, loading and decoding.")
+    parser.add_argument("--corpora", nargs="+", choices=list(CORPORA), default=list(CORPORA))
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES))
+    parser.add_argument("--repeat", type=int, default=3,
+        help="decoding runs per mode, of which the fastest counts (default: 3)")
+    parser.add_argument("--output", default="bench.json",
+        help="results file to write (default: bench.json)")
+    parser.add_argument("--baseline", default=None,
+        help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+        help="fraction by which a metric may get worse (default: {})".format(TOLERANCE))
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    t0 = time.time()
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "repeat": args.repeat,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": run_benchmarks(args),
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print("Wrote {}".format(args.output))
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report["results"], baseline["results"], args.tolerance)
+        print("{} regressions beyond {:.0%}".format(len(regressions), args.tolerance))
+
+    print("Time taken to run: {}".format(time.time() - t0))
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
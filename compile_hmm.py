@@ -0,0 +1,32 @@
+"""
+HMM Compiler
+
+Converts a text HMM file written by train_hmm.py into a single binary
+file holding the tag and vocabulary index tables and the pre-logged
+probability arrays. viterbi.py recognises compiled files by their magic
+number and memory-maps them instead of parsing the text format, which
+removes most of its startup time and lets concurrent taggers share the
+mapped pages.
+
+Usage: python compile_hmm.py <HMM_FILE> <COMPILED_FILE>
+
+"""
+
+import sys
+import time
+
+import viterbi
+
+def main():
+    (hmm_file, compiled_file) = sys.argv[1:3]
+
+    t0 = time.time()
+    viterbi.load_model(hmm_file)
+    viterbi.save_compiled_model(compiled_file)
+    t1 = time.time()
+
+    print("Compiled {} states and {} words".format(len(viterbi.tags), len(viterbi.word_index)))
+    print("Time taken to run: {}".format(t1 - t0))
+
+if __name__ == "__main__":
+    main()
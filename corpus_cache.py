@@ -0,0 +1,139 @@
+"""
+Corpus Cache
+
+Converts a text or tags file (one sentence per line, tokens separated by
+whitespace) into a binary corpus cache: the file's vocabulary, a flat
+array of token ids and the offset of each sentence in it. A cache is
+built once and then memory-mapped, so tools that read the same files
+over and over skip reading, splitting and string lookups.
+
+viterbi.py, train_hmm.py and tag_acc.py accept a cache anywhere they take
+a text or tags file, recognizing it by its first bytes.
+
+Usage: python corpus_cache.py <TEXT_FILE> <CACHE_FILE>
+
+Lines are split as line.split() does, so a blank line is an empty
+sentence. The vocabulary lists tokens in order of first occurrence.
+
+Requires NumPy.
+
+"""
+
+import argparse
+import collections
+import json
+import mmap
+import time
+
+from array import array
+
+import numpy as np
+
+CACHE_MAGIC = b"CORP0001"   # first bytes of a corpus cache
+CACHE_ALIGNMENT = 64        # byte alignment of each array in a cache
+
+# vocab lists the token strings by id, and sentence i is
+#   tokens[offsets[i]:offsets[i + 1]]
+Corpus = collections.namedtuple("Corpus", ["vocab", "tokens", "offsets"])
+
+# Tokenize lines of text into a Corpus held in memory
+def build_corpus(lines):
+    vocab_ids = {}
+    tokens = array("i")
+    offsets = array("q", [0])
+    for line in lines:
+        tokens.extend(vocab_ids.setdefault(token, len(vocab_ids)) for token in line.split())
+        offsets.append(len(tokens))
+    return Corpus(list(vocab_ids),
+        np.frombuffer(tokens, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64))
+
+# Write a Corpus to a cache file: magic, 8-byte header length, JSON header,
+#   then the token and offset arrays at aligned offsets recorded in the
+#   header, as in the compiled HMM format
+def save_corpus(corpus, path):
+    arrays = {"tokens": corpus.tokens, "offsets": corpus.offsets}
+    header = {"vocab": corpus.vocab, "arrays": {}}
+
+    offset = 0
+    for (name, values) in arrays.items():
+        header["arrays"][name] = {"dtype": values.dtype.str, "shape": values.shape, "offset": offset}
+        offset += -(-values.nbytes // CACHE_ALIGNMENT) * CACHE_ALIGNMENT
+
+    encoded = json.dumps(header).encode("utf-8")
+    start = len(CACHE_MAGIC) + 8 + len(encoded)
+    start += -start % CACHE_ALIGNMENT
+    with open(path, "wb") as f:
+        f.write(CACHE_MAGIC)
+        f.write(len(encoded).to_bytes(8, "little"))
+        f.write(encoded)
+        for (name, values) in arrays.items():
+            f.seek(start + header["arrays"][name]["offset"])
+            f.write(np.ascontiguousarray(values).tobytes())
+
+# Memory-map a cache file written by save_corpus
+def load_corpus(path):
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header_start = len(CACHE_MAGIC) + 8
+    header_length = int.from_bytes(mapped[len(CACHE_MAGIC):header_start], "little")
+    header = json.loads(mapped[header_start:header_start + header_length])
+    start = header_start + header_length
+    start += -start % CACHE_ALIGNMENT
+
+    arrays = {}
+    for (name, spec) in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"]))
+        if count == 0:
+            arrays[name] = np.empty(spec["shape"], dtype=dtype)
+            continue
+        arrays[name] = np.frombuffer(mapped, dtype=dtype, count=count,
+            offset=start + spec["offset"]).reshape(spec["shape"])
+
+    return Corpus(header["vocab"], arrays["tokens"], arrays["offsets"])
+
+# Whether path is a corpus cache rather than a text file
+def is_corpus(path):
+    with open(path, "rb") as f:
+        return f.read(len(CACHE_MAGIC)) == CACHE_MAGIC
+
+# Load a cache, or tokenize a text file into an in-memory Corpus
+def open_corpus(path):
+    if is_corpus(path):
+        return load_corpus(path)
+    with open(path, "r") as f:
+        return build_corpus(f)
+
+# Token id arrays of each sentence, with ids mapped through id_map if given
+def sentence_ids(corpus, id_map=None):
+    if len(corpus.offsets) == 1:
+        return []
+    tokens = corpus.tokens if id_map is None else id_map[corpus.tokens]
+    return np.split(tokens, corpus.offsets[1:-1])
+
+# Token string lists of each sentence
+def sentence_tokens(corpus):
+    vocab = np.array(corpus.vocab, dtype=object)
+    return [sentence.tolist() for sentence in sentence_ids(corpus, vocab)]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert a text or tags file into a corpus cache.")
+    parser.add_argument("text_file")
+    parser.add_argument("cache_file")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    t0 = time.time()
+    with open(args.text_file, "r") as f:
+        corpus = build_corpus(f)
+    save_corpus(corpus, args.cache_file)
+
+    print("Cached {} sentences, {} tokens and {} types".format(
+        len(corpus.offsets) - 1, len(corpus.tokens), len(corpus.vocab)))
+    print("Time taken to run: {}".format(time.time() - t0))
+
+if __name__ == "__main__":
+    main()
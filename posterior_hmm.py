@@ -0,0 +1,203 @@
+"""
+HMM Posteriors
+
+Runs the forward-backward algorithm of the bigram HMM over a text file
+to give per-token tag posteriors and sentence log-likelihoods. The model
+is loaded by viterbi.py, so it may be a text or compiled HMM file, and
+the text may be a corpus cache.
+
+Usage: python posterior_hmm.py [--topk K | --loglik] [--batch-size N]
+                               <HMM_FILE> <TEXT_FILE> <OUTPUT_FILE>
+
+By default each sentence is tagged with its most probable tag at every
+word (posterior or max-marginal decoding), one line per sentence as
+viterbi.py writes them, so tag_acc.py scores the output as it is. With
+--topk K each sentence is written as a JSON line instead, holding those
+tags, the sentence log-likelihood and the K most probable tags of every
+word with their posterior probabilities. With --loglik only the forward
+pass is run and the log-likelihood of each sentence is written, one per
+line. The total log-likelihood and the per-token perplexity of the file
+are printed at the end.
+
+Sentences are read in blocks of BLOCK_LINES, sorted by length and run in
+batches of --batch-size, with each step of the recursions one array
+operation for the whole batch. The recursions stay in log space: every
+log-sum-exp is taken as a matrix product of the exponentials shifted by
+their row maximum. A sentence no path can tag gets an empty line and a
+log-likelihood of -inf.
+
+Requires NumPy.
+
+"""
+
+import argparse
+import itertools
+import json
+import math
+import time
+
+import numpy as np
+
+import corpus_cache
+import viterbi
+
+BLOCK_LINES = 4096   # lines read and sorted together
+TOPK_DIGITS = 6      # decimals of the probabilities written by --topk
+
+# log(exp(scores) @ weights), row by row, with weights given as probabilities
+# Each row is shifted by its maximum so the exponentials cannot underflow;
+#   rows of only -inf stay -inf
+def log_matmul(scores, weights):
+    shift = scores.max(axis=-1, keepdims=True)
+    shift[~np.isfinite(shift)] = 0.0
+    with np.errstate(divide="ignore"):
+        return np.log(np.exp(scores - shift) @ weights) + shift
+
+# Dense [word, sentence, state] emission log probabilities of a padded
+#   (sentences x words) array of word indices, filled from the sparse table
+def batch_emissions(ids):
+    flat = ids.T.ravel()
+    counts = np.diff(viterbi.emission_offsets)[flat]
+    (owner, k, starts) = viterbi.ragged_arange(counts)
+    entries = viterbi.emission_offsets[flat[owner]] + k
+    emissions = np.full((len(flat), len(viterbi.tags)), -np.inf)
+    emissions[owner, viterbi.emission_states[entries]] = viterbi.emission_scores[entries]
+    return emissions.reshape(ids.shape[1], ids.shape[0], len(viterbi.tags))
+
+# Forward pass over a batch: alpha[x][s][y] is the log probability of the
+#   first x + 1 words of sentence s with word x tagged y
+# Returns alpha and the log-likelihood of each sentence, taken at its own
+#   last word
+def forward(emissions, lengths):
+    transitions = np.exp(viterbi.log_bitransition)
+    alpha = np.empty_like(emissions)
+    alpha[0] = viterbi.log_bitransition[viterbi.init_index] + emissions[0]
+    for i in range(1, len(emissions)):
+        alpha[i] = log_matmul(alpha[i - 1], transitions) + emissions[i]
+
+    last = alpha[lengths - 1, np.arange(len(lengths))]
+    loglik = log_matmul(last, transitions[:, [viterbi.final_index]])[:, 0]
+    return (alpha, loglik)
+
+# Backward pass over a batch: beta[x][s][y] is the log probability of the
+#   words after x of sentence s and the final state, given tag y at word x
+# Rows start at their own last word, so the padding after it is ignored
+def backward(emissions, lengths):
+    transitions = np.exp(viterbi.log_bitransition)
+    beta = np.empty_like(emissions)
+    end = viterbi.log_bitransition[:, viterbi.final_index]
+    beta[-1] = end
+    for i in range(len(emissions) - 2, -1, -1):
+        step = log_matmul(emissions[i + 1] + beta[i + 1], transitions.T)
+        beta[i] = np.where((lengths == i + 1)[:, np.newaxis], end, step)
+    return beta
+
+# Run a batch of non-empty sentences of word indices, all of which have
+#   lengths that fit ids; returns each sentence's log-likelihood and,
+#   unless loglik_only, its [word, state] posterior log probabilities
+def run_batch(ids, lengths, loglik_only):
+    emissions = batch_emissions(ids)
+    (alpha, loglik) = forward(emissions, lengths)
+    if loglik_only:
+        return (loglik, None)
+
+    beta = backward(emissions, lengths)
+    with np.errstate(invalid="ignore"):
+        posteriors = alpha + beta - loglik[:, np.newaxis]
+    return (loglik, [posteriors[:lengths[row], row] for row in range(len(lengths))])
+
+# Log-likelihoods and posteriors of sentences of word indices, in the given
+#   order, decoded in length-sorted batches as in viterbi.decode_batches
+def run_sentences(sentences, batch_size, loglik_only):
+    empty_loglik = float(viterbi.log_bitransition[viterbi.init_index, viterbi.final_index])
+    logliks = [empty_loglik] * len(sentences)
+    posteriors = [np.zeros((0, len(viterbi.tags)))] * len(sentences)
+    lengths = np.array([len(sentence) for sentence in sentences], dtype=np.intp)
+    order = np.argsort(lengths, kind="stable")
+    order = order[lengths[order] > 0]
+    for start in range(0, len(order), batch_size):
+        bucket = order[start:start + batch_size]
+        ids = np.full((len(bucket), lengths[bucket[-1]]), viterbi.oov_index, dtype=np.intp)
+        for (row, sentence) in enumerate(bucket):
+            ids[row, :lengths[sentence]] = sentences[sentence]
+
+        (bucket_logliks, bucket_posteriors) = run_batch(ids, lengths[bucket], loglik_only)
+        for (row, sentence) in enumerate(bucket):
+            logliks[sentence] = float(bucket_logliks[row])
+            if not loglik_only:
+                posteriors[sentence] = bucket_posteriors[row]
+    return (logliks, posteriors)
+
+# Format one sentence's results as a line of output
+def format_sentence(loglik, posteriors, args):
+    if args.loglik:
+        return repr(loglik)
+    if loglik == -np.inf:
+        sequence = []
+    else:
+        sequence = [viterbi.tags[state] for state in posteriors.argmax(axis=1).tolist()]
+    if args.topk is None:
+        return " ".join(sequence)
+
+    top = []
+    if sequence:
+        states = (-posteriors).argsort(axis=1, kind="stable")[:, :args.topk]
+        probs = np.exp(np.take_along_axis(posteriors, states, axis=1))
+        top = [[[viterbi.tags[state], round(prob, TOPK_DIGITS)] for (state, prob) in zip(row_states, row_probs)]
+            for (row_states, row_probs) in zip(states.tolist(), probs.tolist())]
+    return json.dumps({"tags": sequence, "loglik": loglik, "topk": top})
+
+# Sentences of the text file as arrays of word indices, BLOCK_LINES at a time
+def read_blocks(path):
+    if corpus_cache.is_corpus(path):
+        sentences = iter(viterbi.corpus_sentences(path))
+        yield from iter(lambda: list(itertools.islice(sentences, BLOCK_LINES)), [])
+        return
+    with open(path, "r") as f:
+        sentences = (np.array(viterbi.line_indices(line), dtype=np.intp) for line in f)
+        yield from iter(lambda: list(itertools.islice(sentences, BLOCK_LINES)), [])
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Tag posteriors and log-likelihoods of text under an HMM.")
+    parser.add_argument("hmm_file")
+    parser.add_argument("text_file")
+    parser.add_argument("output_file")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--topk", type=int, default=None, metavar="K",
+        help="write JSON lines with the K most probable tags of every word")
+    output.add_argument("--loglik", action="store_true",
+        help="only write the log-likelihood of each sentence")
+    parser.add_argument("--batch-size", type=int, default=viterbi.BATCH_SIZE, metavar="N",
+        help="sentences run together (default: {})".format(viterbi.BATCH_SIZE))
+    args = parser.parse_args()
+    if args.topk is not None and args.topk < 1:
+        parser.error("--topk must be at least 1")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    return args
+
+def main():
+    args = parse_args()
+
+    t0 = time.time()
+    viterbi.load_model(args.hmm_file)
+
+    num_lines = num_tokens = 0
+    total_loglik = 0.0
+    with open(args.output_file, "w") as f:
+        for block in read_blocks(args.text_file):
+            (logliks, posteriors) = run_sentences(block, args.batch_size, args.loglik)
+            for (sentence, loglik, sentence_posteriors) in zip(block, logliks, posteriors):
+                f.write(format_sentence(loglik, sentence_posteriors, args) + "\n")
+                # Tokens plus the final state, as the likelihood includes it
+                num_tokens += len(sentence) + 1
+                total_loglik += loglik
+            num_lines += len(block)
+
+    print("Processed {} lines".format(num_lines))
+    perplexity = math.exp(min(-total_loglik / num_tokens, 700.0)) if num_tokens else float("nan")
+    print("Log-likelihood: {} (perplexity per token {})".format(total_loglik, perplexity))
+    print("Time taken to run: {}".format(time.time() - t0))
+
+if __name__ == "__main__":
+    main()
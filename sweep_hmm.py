@@ -0,0 +1,184 @@
+"""
+Smoothing Sweep
+
+Counts a training corpus once, or loads the counts that train_hmm.py
+saved next to a model, and then estimates one model in memory for every
+combination of smoothing constant and interpolation setting. Each model
+tags a development set and is scored against its gold tags. The
+configurations are spread over a process pool, and a table of error
+rates and timings is printed.
+
+Usage: python sweep_hmm.py (--train TAG_FILE TEXT_FILE | --counts COUNTS_FILE)
+                           [--smoothing K ...] [--interpolation SETTING ...]
+                           [--workers N] <DEV_TEXT_FILE> <DEV_TAG_FILE>
+
+An interpolation setting is "bigram" for the bigram decoder, "deleted"
+for the trigram decoder with the deleted-interpolation weights estimated
+from the counts, or three comma-separated unigram,bigram,trigram weights
+(e.g. 0.1,0.3,0.6) for the trigram decoder with fixed weights. Fixed
+weights must have a positive sum and are scaled to sum to 1.
+
+Requires NumPy.
+
+"""
+
+import argparse
+import itertools
+import math
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import tag_acc
+import train_hmm
+import viterbi
+
+# Training counts and development data, set in each worker by init_worker
+counts = None
+dev_lines = None
+gold_lines = None
+
+def init_worker(worker_counts, worker_dev_lines, worker_gold_lines):
+    global counts, dev_lines, gold_lines
+    (counts, dev_lines, gold_lines) = (worker_counts, worker_dev_lines, worker_gold_lines)
+
+# Turn a model estimated by train_hmm.estimate into the tables and suffix
+#   model signatures that viterbi.install_model takes
+# States are in sorted order and logs are taken with math.log, as when
+#   viterbi.py reads the written model, so decoding matches the file-based
+#   pipeline exactly
+def model_tables(model):
+    order = model["tag_order"]
+    tag_list = model["tags"][order].tolist()
+    position = np.empty(len(order), dtype=np.int64)
+    position[order] = np.arange(len(order))
+
+    def log(probs):
+        return np.array(list(map(math.log, probs.tolist())), dtype=np.float64)
+
+    # Only words with an emission entry are in the vocabulary; words seen
+    #   once were counted as OOV and stay unknown to the decoder
+    (emission_tags, emission_words, emit) = model["emissions"]
+    word_ids = np.union1d(emission_words, [train_hmm.OOV_ID])
+    word_list = model["words"][word_ids].tolist()
+    word_position = np.searchsorted(word_ids, emission_words)
+
+    (rows, columns, scores) = (word_position, position[emission_tags], log(emit))
+
+    # Signature rows of the suffix model follow the words, as when
+    #   viterbi.py compiles the written model
+    (signatures, suffix_tags, suffix_probs) = model["suffixes"]
+    (theta, max_suffix) = model["suffix_norms"]
+    signature_list = []
+    if len(signatures):
+        oov = rows == np.searchsorted(word_ids, train_hmm.OOV_ID)
+        (signature_list, signature_rows, signature_columns, signature_scores) = viterbi.suffix_emissions(
+            signatures.tolist(), position[suffix_tags], suffix_probs, theta, columns[oov], scores[oov], len(tag_list))
+        rows = np.concatenate([rows, signature_rows + len(word_list)])
+        columns = np.concatenate([columns, signature_columns])
+        scores = np.concatenate([scores, signature_scores])
+    emissions = viterbi.sparse_emissions(rows, columns, scores, len(word_list) + len(signature_list))
+
+    (unigram_tags, unigram) = model["unigrams"]
+    log_unigram = np.full(len(tag_list), -np.inf)
+    log_unigram[position[unigram_tags]] = log(unigram)
+
+    (a, b, c, tritrans) = model["trigrams"]
+    arrays = dict(emissions,
+        log_bitransition=log(model["bitrans"].ravel()).reshape(model["bitrans"].shape),
+        log_unigram=log_unigram,
+        tritransition_index=np.stack([position[a], position[b], position[c]], axis=1).astype(np.int32),
+        log_tritransition=log(tritrans),
+    )
+    return (tag_list, word_list, arrays, signature_list, max_suffix)
+
+# Pool task: build, decode and score one (smoothing, interpolation) setting
+def run_config(config):
+    (smoothing, interpolation) = config
+
+    t0 = time.time()
+    model = train_hmm.estimate(counts, smoothing)
+    (tag_list, word_list, arrays, signature_list, max_suffix) = model_tables(model)
+    norms = model["norms"]
+    if interpolation not in ("bigram", "deleted"):
+        weights = [float(weight) for weight in interpolation.split(",")]
+        norms = tuple(weight / sum(weights) for weight in weights)
+    viterbi.install_model(tag_list, word_list, norms, arrays, signature_list, max_suffix)
+    t1 = time.time()
+
+    results = viterbi.viterbi(dev_lines, trigram=interpolation != "bigram")
+    t2 = time.time()
+
+    result = tag_acc.score_lines(gold_lines, [results])[0]
+    word_error = tag_acc.rate(result["token_errors"], result["tokens"])
+    sentence_error = tag_acc.rate(result["sentence_errors"], result["sentences"])
+    return (smoothing, interpolation, word_error, sentence_error, t1 - t0, t2 - t1)
+
+def interpolation_setting(value):
+    if value in ("bigram", "deleted"):
+        return value
+    weights = value.split(",")
+    try:
+        weights = [float(weight) for weight in weights]
+        if len(weights) == 3 and all(0 <= weight < math.inf for weight in weights) and sum(weights) > 0:
+            return value
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(
+        "expected bigram, deleted or three non-negative unigram,bigram,trigram weights "
+        "with a positive sum, got {!r}".format(value))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sweep HMM smoothing and interpolation settings.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--train", nargs=2, metavar=("TAG_FILE", "TEXT_FILE"),
+        help="training files to count")
+    source.add_argument("--counts", metavar="COUNTS_FILE",
+        help="counts saved by train_hmm.py")
+    parser.add_argument("dev_text_file")
+    parser.add_argument("dev_tag_file")
+    parser.add_argument("--smoothing", type=float, nargs="+", default=[0.01, 0.1, 0.5, 1.0],
+        help="smoothing constants to try (default: 0.01 0.1 0.5 1.0)")
+    parser.add_argument("--interpolation", type=interpolation_setting, nargs="+",
+        default=["bigram", "deleted"],
+        help="interpolation settings to try (default: bigram deleted)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+        help="processes decoding configurations (default: number of CPUs)")
+    args = parser.parse_args()
+    if any(smoothing <= 0 for smoothing in args.smoothing):
+        parser.error("smoothing constants must be positive, or unseen events get no probability")
+    return args
+
+def main():
+    args = parse_args()
+
+    t0 = time.time()
+    if args.counts:
+        sweep_counts = train_hmm.load_counts(args.counts)
+    else:
+        (tag_path, token_path) = args.train
+        with open(tag_path) as tag_file, open(token_path) as token_file:
+            sweep_counts = train_hmm.count_corpus(tag_file, token_file)
+    t1 = time.time()
+
+    with open(args.dev_text_file) as f:
+        sweep_dev_lines = f.readlines()
+    with open(args.dev_tag_file) as f:
+        sweep_gold_lines = f.readlines()
+
+    print("Counted {} training lines in {:.2f}s".format(sweep_counts["num_sentences"], t1 - t0))
+    print("{:>10}  {:<16}  {:>10}  {:>10}  {:>8}  {:>8}".format(
+        "smoothing", "interpolation", "word err", "sent err", "build s", "decode s"))
+
+    configs = list(itertools.product(args.smoothing, args.interpolation))
+    with multiprocessing.Pool(args.workers, initializer=init_worker,
+            initargs=(sweep_counts, sweep_dev_lines, sweep_gold_lines)) as pool:
+        for row in pool.imap(run_config, configs):
+            print("{:>10g}  {:<16}  {:>10.5f}  {:>10.5f}  {:>8.2f}  {:>8.2f}".format(*row), flush=True)
+
+    print("Time taken to run: {}".format(time.time() - t0))
+
+if __name__ == "__main__":
+    main()
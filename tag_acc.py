@@ -6,66 +6,258 @@ Noah A. Smith
 
 Calculates and prints error rate by word and sentence
 
-Usage: python tag_acc.py gold-standard-tags hypothesized-tags
+Usage: python tag_acc.py [--per-tag] [--confusion N] [--text TEXT_FILE --model HMM_FILE]
+                         [--json FILE] gold-standard-tags hypothesized-tags [hypothesized-tags ...]
 
 Uses a word level hamming distance measure.
 Produces catastrophically bad results if for some reason the
 sentences have a different number of tags, or if
 some lines are missing. This is intended.
 
+Several hypothesis files are scored against the gold file in one pass
+over all of them. Tags are mapped to integer ids as lines are read, and
+each block of lines is added to a gold x hypothesis confusion matrix per
+file with numpy, from which all the rates are computed.
+
+--per-tag prints the precision and recall of every tag, and --confusion
+the N most frequent confusions. With --text (the text that was tagged)
+and --model (the HMM that tagged it) the error rate is also split into
+words in and out of the model's vocabulary. --json writes everything,
+including the full confusion matrices, to FILE.
+
+Any of the files may be a corpus cache written by corpus_cache.py. Lines
+are split on whitespace.
+
+Requires NumPy.
+
 """
 
-import sys
-import re
+import argparse
+import json
 
+from array import array
 from itertools import zip_longest
 
-# Get files
-GOLD_TAGS = sys.argv[1]
-MY_TAGS = sys.argv[2]
-
-# Stats
-num_sentences = 0
-num_sentence_errors = 0
-num_tokens = 0
-num_token_errors = 0
-
-# Iterate over both files
-gold_tags = []
-with open(GOLD_TAGS, "r") as gold_tags, open(MY_TAGS, "r") as my_tags:
-
-    # zip_longest allows us to iterate over the length of the longer list
-    for (gold_tag_line, my_tag_line) in zip_longest(gold_tags, my_tags):
-
-        # Terminate loop if more lines in my_tags than gold_tags
-        if not gold_tag_line:
-            break
-
-        # If missing line, add entire missing line to error num stats
-        num_sentences += 1
-        if not my_tag_line:
-            num_sentence_errors += 1
-            gold_tag = re.split("\s+", gold_tags.rstrip())            
-            num_tokens += len(gold_tag)
-            num_token_errors += len(gold_tag)
-            continue
-
-        # Otherwise, compare both lines token by token
-        sentence_errors = 0
-        for (gold_tag, my_tag) in zip_longest(re.split("\s+", gold_tag_line.rstrip()), re.split("\s+", my_tag_line.rstrip())):
-
-            # Terminate line if my_tag_line longer than gold_tag_line
-            if not gold_tag:
+import numpy as np
+
+import corpus_cache
+import viterbi
+
+MISSING = 0              # tag id of a hypothesis tag that is not there
+MISSING_TAG = "<none>"   # how a missing tag is shown
+BLOCK_LINES = 4096       # lines buffered before they are added to the counts
+
+# Accumulates the confusion matrices, sentence errors and OOV splits of
+#   several hypotheses against one gold standard
+class Evaluator:
+    def __init__(self, num_hypotheses):
+        self.num_hypotheses = num_hypotheses
+        self.tag_ids = {}
+        self.num_sentences = 0
+        self.confusion = [np.zeros((1, 1), dtype=np.int64) for h in range(num_hypotheses)]
+        self.sentence_errors = [0] * num_hypotheses
+        # oov_counts[h][2 * is_oov + is_error]
+        self.oov_counts = [np.zeros(4, dtype=np.int64) for h in range(num_hypotheses)]
+        self.has_oov = False
+        self.new_block()
+
+    def new_block(self):
+        self.gold = array("i")
+        self.hypotheses = [array("i") for h in range(self.num_hypotheses)]
+        self.missing = [array("b") for h in range(self.num_hypotheses)]
+        self.lengths = array("i")
+        self.oov = array("b")
+
+    # Tag ids of a list of tag strings, with new tags given new ids
+    def encode(self, tags):
+        tag_ids = self.tag_ids
+        return [tag_ids.setdefault(tag, len(tag_ids) + 1) for tag in tags]
+
+    # Score lines of gold tag ids against lines of tag ids from each
+    #   hypothesis, and optionally lines of flags for which gold words are OOV
+    # Gold lines decide what is scored: hypothesis tags past the end of a
+    #   gold line and hypothesis lines past the end of the gold are ignored,
+    #   and missing hypothesis tags and lines count as errors
+    def run(self, gold, hypotheses, oov=None):
+        self.has_oov = oov is not None
+        lines = zip_longest(gold, *hypotheses, *([oov] if self.has_oov else []))
+        for (i, line) in enumerate(lines):
+            gold_tags = line[0]
+
+            # Terminate loop if more lines in a hypothesis than in the gold
+            if gold_tags is None:
+                break
+
+            n = len(gold_tags)
+            self.gold.extend(gold_tags)
+            self.lengths.append(n)
+            for (h, hypothesis_tags) in enumerate(line[1:self.num_hypotheses + 1]):
+                self.missing[h].append(hypothesis_tags is None)
+                hypothesis_tags = (hypothesis_tags or [])[:n]
+                self.hypotheses[h].extend(hypothesis_tags)
+                self.hypotheses[h].extend([MISSING] * (n - len(hypothesis_tags)))
+            if self.has_oov:
+                oov_flags = (line[-1] or [])[:n]
+                self.oov.extend(oov_flags)
+                self.oov.extend([False] * (n - len(oov_flags)))
+
+            if (i + 1) % BLOCK_LINES == 0:
+                self.add_block()
+        self.add_block()
+
+    # Add the buffered lines to the counts
+    def add_block(self):
+        num_tags = len(self.tag_ids) + 1
+        gold = np.frombuffer(self.gold, dtype=np.int32).astype(np.int64)
+        lengths = np.frombuffer(self.lengths, dtype=np.int32)
+        sentence = np.repeat(np.arange(len(lengths)), lengths)
+        oov = np.frombuffer(self.oov, dtype=np.int8).astype(np.int64)
+        self.num_sentences += len(lengths)
+
+        for h in range(self.num_hypotheses):
+            hypothesis = np.frombuffer(self.hypotheses[h], dtype=np.int32)
+            confusion = np.zeros((num_tags, num_tags), dtype=np.int64)
+            (rows, columns) = self.confusion[h].shape
+            confusion[:rows, :columns] = self.confusion[h]
+            confusion += np.bincount(gold * num_tags + hypothesis,
+                minlength=num_tags * num_tags).reshape(num_tags, num_tags)
+            self.confusion[h] = confusion
+
+            errors = gold != hypothesis
+            wrong_sentences = np.bincount(sentence, weights=errors, minlength=len(lengths)) > 0
+            wrong_sentences |= np.frombuffer(self.missing[h], dtype=np.int8).astype(bool)
+            self.sentence_errors[h] += int(wrong_sentences.sum())
+            if self.has_oov:
+                self.oov_counts[h] += np.bincount(2 * oov + errors, minlength=4)
+
+        self.new_block()
+
+    # Scores of each hypothesis as a dict
+    def results(self):
+        tags = [MISSING_TAG] + list(self.tag_ids)
+        results = []
+        for h in range(self.num_hypotheses):
+            confusion = self.confusion[h]
+            correct = np.diag(confusion)
+            num_tokens = int(confusion.sum())
+            result = {
+                "tokens": num_tokens,
+                "token_errors": num_tokens - int(correct.sum()),
+                "sentences": self.num_sentences,
+                "sentence_errors": self.sentence_errors[h],
+                "tags": tags,
+                "confusion": confusion.tolist(),
+                "per_tag": {tag: {
+                    "gold": int(confusion[t].sum()),
+                    "predicted": int(confusion[:, t].sum()),
+                    "precision": rate(correct[t], confusion[:, t].sum()),
+                    "recall": rate(correct[t], confusion[t].sum()),
+                } for (t, tag) in enumerate(tags) if t != MISSING},
+            }
+            if self.has_oov:
+                (in_vocab_correct, in_vocab_errors, oov_correct, oov_errors) = self.oov_counts[h].tolist()
+                result["in_vocab_tokens"] = in_vocab_correct + in_vocab_errors
+                result["in_vocab_errors"] = in_vocab_errors
+                result["oov_tokens"] = oov_correct + oov_errors
+                result["oov_errors"] = oov_errors
+            results.append(result)
+        return results
+
+def rate(numerator, denominator):
+    return float(numerator / denominator) if denominator else 0.0
+
+# Lines of a file (text or corpus cache) as lists of values, where convert
+#   turns a list of token strings into their values; a cache's vocabulary
+#   is converted once
+def read_lines(path, convert):
+    if corpus_cache.is_corpus(path):
+        corpus = corpus_cache.load_corpus(path)
+        for sentence in corpus_cache.sentence_ids(corpus, np.array(convert(corpus.vocab))):
+            yield sentence.tolist()
+        return
+    with open(path, "r") as f:
+        for line in f:
+            yield convert(line.split())
+
+# Score lines of tags held in memory, one list of lines per hypothesis
+def score_lines(gold_lines, hypothesis_lines):
+    evaluator = Evaluator(len(hypothesis_lines))
+    encode = lambda lines: (evaluator.encode(line.split()) for line in lines)
+    evaluator.run(encode(gold_lines), [encode(lines) for lines in hypothesis_lines])
+    return evaluator.results()
+
+def print_results(result, args):
+    print("Error rate by word: {} ({} errors out of {})".format(
+        rate(result["token_errors"], result["tokens"]), result["token_errors"], result["tokens"]))
+    print("Error rate by sentence: {} ({} errors out of {})".format(
+        rate(result["sentence_errors"], result["sentences"]), result["sentence_errors"], result["sentences"]))
+
+    if "oov_tokens" in result:
+        print("Error rate on in-vocabulary words: {} ({} errors out of {})".format(
+            rate(result["in_vocab_errors"], result["in_vocab_tokens"]),
+            result["in_vocab_errors"], result["in_vocab_tokens"]))
+        print("Error rate on OOV words: {} ({} errors out of {})".format(
+            rate(result["oov_errors"], result["oov_tokens"]), result["oov_errors"], result["oov_tokens"]))
+
+    if args.per_tag:
+        print("{:<10} {:>8} {:>10} {:>10}".format("tag", "gold", "precision", "recall"))
+        for (tag, scores) in sorted(result["per_tag"].items()):
+            print("{:<10} {:>8} {:>10.4f} {:>10.4f}".format(
+                tag, scores["gold"], scores["precision"], scores["recall"]))
+
+    if args.confusion:
+        confusion = np.array(result["confusion"])
+        np.fill_diagonal(confusion, 0)
+        print("Most frequent confusions (gold -> hypothesis):")
+        for flat in np.argsort(-confusion, axis=None, kind="stable")[:args.confusion]:
+            (gold, hypothesis) = np.unravel_index(flat, confusion.shape)
+            if confusion[gold, hypothesis] == 0:
                 break
+            print("  {} -> {}: {}".format(
+                result["tags"][gold], result["tags"][hypothesis], confusion[gold, hypothesis]))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Score tagger output against gold tags.")
+    parser.add_argument("gold_file")
+    parser.add_argument("hypothesis_files", nargs="+")
+    parser.add_argument("--per-tag", action="store_true",
+        help="print precision and recall of every tag")
+    parser.add_argument("--confusion", type=int, default=0, metavar="N",
+        help="print the N most frequent confusions")
+    parser.add_argument("--text", default=None, metavar="TEXT_FILE",
+        help="the tagged text, to split errors into in-vocabulary and OOV words (needs --model)")
+    parser.add_argument("--model", default=None, metavar="HMM_FILE",
+        help="the HMM whose vocabulary decides which words are OOV (needs --text)")
+    parser.add_argument("--json", default=None, metavar="FILE",
+        help="write all results as JSON to FILE")
+    args = parser.parse_args()
+    if (args.text is None) != (args.model is None):
+        parser.error("--text and --model go together")
+    return args
+
+def main():
+    args = parse_args()
+
+    evaluator = Evaluator(len(args.hypothesis_files))
+    oov = None
+    if args.model is not None:
+        viterbi.load_model(args.model)
+        vocab = viterbi.word_index
+        oov = read_lines(args.text, lambda words: [word not in vocab for word in words])
+
+    evaluator.run(read_lines(args.gold_file, evaluator.encode),
+        [read_lines(path, evaluator.encode) for path in args.hypothesis_files], oov)
+    results = evaluator.results()
 
-            num_tokens += 1
-            if gold_tag != my_tag:
-                num_token_errors += 1
-                sentence_errors += 1
+    # Print stats
+    for (path, result) in zip(args.hypothesis_files, results):
+        if len(results) > 1:
+            print("== {} ==".format(path))
+        print_results(result, args)
 
-        if sentence_errors > 0:
-            num_sentence_errors += 1
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(dict(zip(args.hypothesis_files, results)), f, indent=1)
 
-# Print stats
-print("Error rate by word: {} ({} errors out of {})".format(num_token_errors / num_tokens, num_token_errors, num_tokens))
-print("Error rate by sentence: {} ({} errors out of {})".format(num_sentence_errors / num_sentences, num_sentence_errors, num_sentences))
+if __name__ == "__main__":
+    main()
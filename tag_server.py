@@ -0,0 +1,243 @@
+"""
+Tagging Server
+
+Keeps an HMM loaded in a long-running process and tags sentences sent
+to it over HTTP on localhost, so callers pay neither interpreter startup
+nor model loading per request. Concurrent requests are grouped into
+micro-batches: the decoder thread waits up to --max-wait seconds for
+more requests once one arrives, up to --max-batch sentences, and hands
+the whole batch to viterbi.batch_viterbi, which decodes it in
+length-sorted buckets of --bucket-size sentences.
+
+Usage: python tag_server.py serve [--port PORT] [--trigram] [--beam K]
+                                  [--max-batch N] [--max-wait SECONDS]
+                                  [--bucket-size N] <HMM_FILE>
+       python tag_server.py client [--url URL] [--batch N] [--jsonl]
+                                   <TEXT_FILE> <OUTPUT_FILE>
+
+POST /tag takes either plain text with one sentence per line, or JSONL
+(Content-Type: application/jsonl) with one {"text": ...} object per
+line. The response is a JSON object {"tags": [...], "latency": seconds}
+with one tag line per sentence in input order; latency runs from the
+request being read to its batch being decoded. GET /stats returns the
+request and batch counters together with the decoder's cache counters.
+A malformed request is answered with 400 and one the decoder fails on
+with 500; if a batch fails, its requests are decoded again one at a
+time so the others in it still get their tags.
+
+TEXT_FILE and OUTPUT_FILE may be "-" for stdin and stdout.
+
+"""
+
+import argparse
+import itertools
+import json
+import queue
+import sys
+import threading
+import time
+import urllib.request
+
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import viterbi
+
+DEFAULT_PORT = 8740
+DEFAULT_URL = "http://127.0.0.1:{}".format(DEFAULT_PORT)
+JSONL_CONTENT_TYPE = "application/jsonl"
+
+# Collects the sentences of concurrent requests into micro-batches that a
+#   single thread decodes, then hands each request back its own tag lines
+class Batcher:
+    def __init__(self, trigram, beam, max_batch, max_wait, bucket_size):
+        self.trigram = trigram
+        self.beam = beam
+        self.bucket_size = bucket_size
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.stats = {"requests": 0, "sentences": 0, "batches": 0}
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # Called from the request handler threads; blocks until decoded
+    def tag(self, lines):
+        future = Future()
+        self.requests.put((lines, future))
+        return future.result()
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0][0])
+
+            # Wait a little for more requests to share the decoder call
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                size += len(batch[-1][0])
+
+            lines = [line for (request_lines, future) in batch for line in request_lines]
+            try:
+                results = viterbi.batch_viterbi(lines, self.trigram, self.beam, self.bucket_size)
+            except Exception:
+                # Decode the requests one at a time, so that only the one the
+                #   decoder fails on gets the error
+                self.decode_each(batch)
+                continue
+
+            self.stats["requests"] += len(batch)
+            self.stats["sentences"] += len(lines)
+            self.stats["batches"] += 1
+
+            start = 0
+            for (request_lines, future) in batch:
+                future.set_result(results[start:start + len(request_lines)])
+                start += len(request_lines)
+
+    def decode_each(self, batch):
+        for (request_lines, future) in batch:
+            try:
+                future.set_result(viterbi.batch_viterbi(request_lines, self.trigram, self.beam, self.bucket_size))
+            except Exception as e:
+                future.set_exception(e)
+
+class TagRequestHandler(BaseHTTPRequestHandler):
+    batcher = None
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self.send_error(404)
+            return
+        self.send_json(dict(self.batcher.stats, **viterbi.cache_stats))
+
+    def do_POST(self):
+        if self.path != "/tag":
+            self.send_error(404)
+            return
+
+        t0 = time.time()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+
+        # Split on newlines only, as viterbi.py reads files, rather than on
+        #   every line boundary str.splitlines knows
+        body_lines = body.split("\n")
+        if body_lines[-1] == "":
+            body_lines.pop()
+        try:
+            if self.headers.get("Content-Type", "").startswith(JSONL_CONTENT_TYPE):
+                lines = [json.loads(line)["text"] for line in body_lines if line.strip()]
+                if not all(isinstance(line, str) for line in lines):
+                    raise TypeError("\"text\" must be a string")
+            else:
+                lines = body_lines
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error(400, "Malformed JSONL request: {}".format(e))
+            return
+
+        try:
+            tags = self.batcher.tag(lines)
+        except Exception as e:
+            self.send_error(500, "Decoding failed: {}".format(e))
+            return
+        self.send_json({"tags": tags, "latency": time.time() - t0})
+
+    def send_json(self, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Keep per-request logging off the hot path
+    def log_message(self, format, *args):
+        pass
+
+def serve(args):
+    viterbi.load_model(args.hmm_file)
+    TagRequestHandler.batcher = Batcher(args.trigram, args.beam, args.max_batch, args.max_wait, args.bucket_size)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), TagRequestHandler)
+    print("Serving {} on http://127.0.0.1:{}".format(args.hmm_file, args.port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+# Send a file to the server in batches of lines and write the tags in order
+def client(args):
+    latencies = []
+    with viterbi.open_text(args.text_file, "r") as text_file, viterbi.open_text(args.output_file, "w") as output_file:
+        while True:
+            lines = [line.rstrip("\n") for line in itertools.islice(text_file, args.batch)]
+            if not lines:
+                break
+
+            if args.jsonl:
+                body = "".join(json.dumps({"text": line}) + "\n" for line in lines)
+                content_type = JSONL_CONTENT_TYPE
+            else:
+                body = "".join(line + "\n" for line in lines)
+                content_type = "text/plain"
+            request = urllib.request.Request(args.url + "/tag", data=body.encode("utf-8"),
+                headers={"Content-Type": content_type})
+            with urllib.request.urlopen(request) as response:
+                reply = json.loads(response.read())
+
+            for tags in reply["tags"]:
+                output_file.write(tags + "\n")
+            latencies.append(reply["latency"])
+
+    if latencies:
+        print("Sent {} requests, mean latency {}".format(len(latencies), sum(latencies) / len(latencies)),
+            file=sys.stderr)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve HMM tagging over HTTP.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve")
+    serve_parser.add_argument("hmm_file")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument("--trigram", action="store_true",
+        help="decode with the interpolated trigram model")
+    serve_parser.add_argument("--beam", type=int, default=None, metavar="K",
+        help="beam search keeping the K best states (or state pairs) per word")
+    serve_parser.add_argument("--max-batch", type=int, default=256,
+        help="most sentences decoded in one batch (default: 256)")
+    serve_parser.add_argument("--max-wait", type=float, default=0.002,
+        help="seconds to wait for more requests to batch (default: 0.002)")
+    serve_parser.add_argument("--bucket-size", type=int, default=viterbi.BATCH_SIZE,
+        help="sentences of similar length decoded together (default: {})".format(viterbi.BATCH_SIZE))
+
+    client_parser = commands.add_parser("client")
+    client_parser.add_argument("text_file")
+    client_parser.add_argument("output_file")
+    client_parser.add_argument("--url", default=DEFAULT_URL)
+    client_parser.add_argument("--batch", type=int, default=64,
+        help="sentences per request (default: 64)")
+    client_parser.add_argument("--jsonl", action="store_true",
+        help="send requests as JSONL instead of plain text")
+
+    args = parser.parse_args()
+    if args.command == "serve" and args.beam is not None and args.beam < 1:
+        parser.error("--beam must be at least 1")
+    if args.command == "serve" and args.bucket_size < 1:
+        parser.error("--bucket-size must be at least 1")
+    return args
+
+def main():
+    args = parse_args()
+    if args.command == "serve":
+        serve(args)
+    else:
+        client(args)
+
+if __name__ == "__main__":
+    main()
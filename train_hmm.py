@@ -6,167 +6,693 @@ Noah A. Smith
 Code for maximum likelihood estimation of a bigram HMM from
 column-formatted training data.
 
-Usage:  train_hmm.py tags-file text-file hmm-file
+Usage:  train_hmm.py [--shards N [--workers N] [--counts-dir DIR]]
+                     [--counts-file FILE] [--update] [--smoothing K]
+                     [--rare-count N] [--max-suffix N]
+                     tags-file text-file hmm-file
 
 The training data should consist of one line per sequence, with
 states or symbols separated by whitespace and no trailing whitespace.
 The initial and final states should not be mentioned; they are
 implied.
 
+Tags and words are mapped to integer ids as they are read, and counts
+are accumulated in batches into numpy arrays: a dense tag x tag array
+for bigrams, and sorted arrays of packed integer keys with their counts
+for the sparse emissions and trigrams. The wall time and peak resident
+memory of the run are printed at the end.
+
+With --shards N the paired files are split into N line ranges that are
+counted on a process pool, each worker writing a partial-counts file.
+The partial counts are then merged in corpus order, correcting for the
+first-occurrence-as-OOV rule, so the model is the same as sequential
+training produces.
+
+The raw counts behind the model are saved next to it in a sidecar file
+(hmm-file.counts.npz unless --counts-file is given). With --update the
+counts of the given files are added to those in the sidecar, as if the
+files had been appended to the original training data, and the model is
+rewritten; the time taken depends on the new data and the model size,
+not on the data counted before.
+
+Words seen at most --rare-count times (5 by default) also train a
+suffix model for unknown words: tag distributions of their word shape
+(capitalization, digits, hyphens) and of the shape with each suffix of
+up to --max-suffix letters, which are written as suffix lines. The
+decoder smooths each signature towards the one with a letter less.
+--rare-count 0 leaves the suffix model out.
+
+Either file may instead be a corpus cache written by corpus_cache.py,
+in which case both are counted with array operations over the token ids;
+the lines of a text file given with a cache are split as line.split()
+does. Caches cannot be combined with --shards.
+
+Requires NumPy.
+
 """
 
-import sys
+import argparse
+import collections
+import contextlib
+import io
+import itertools
+import multiprocessing
+import os
 import re
+import resource
+import tempfile
+import time
+
+from array import array
 
-from collections import defaultdict
+import numpy as np
 
-# Files
-TAG_FILE = sys.argv[1]
-TOKEN_FILE = sys.argv[2]
-OUTPUT_FILE = sys.argv[3]
+import corpus_cache
+import word_shapes
 
-# Vocabulary
-vocab = {}
 OOV_WORD = "OOV"
 INIT_STATE = "init"
 FINAL_STATE = "final"
 
-# Transition and emission probabilities
-emissions = {}
-bitransitions = {}
-bitransitions_total = defaultdict(lambda: 0)
-emissions_total = defaultdict(lambda: 0)
-tritransitions = {}
-tritransitions_total = {}
-total_tags = set()
-total_tags.add(FINAL_STATE)
-total_tags.add(INIT_STATE)
-
-with open(TAG_FILE) as tag_file, open(TOKEN_FILE) as token_file:
-    for tag_string, token_string in zip(tag_file, token_file):
-        tags = re.split("\s+", tag_string.rstrip())
-        tokens = re.split("\s+", token_string.rstrip())
-        pairs = zip(tags, tokens)
+# Integer ids reserved for the implied states and the OOV word
+INIT_ID = 0
+FINAL_ID = 1
+OOV_ID = 0
+
+# Emission and trigram keys pack several ids into one int64, TAG_BITS bits
+#   per tag id, so the sparse counts are plain sorted integer arrays
+TAG_BITS = 16
+TAG_MASK = (1 << TAG_BITS) - 1
+BATCH_TOKENS = 1 << 18   # tokens buffered before they are added to the counts
+SCAN_BLOCK_SIZE = 1 << 24   # bytes read at a time when looking for line breaks
+COUNTS_VERSION = 2       # format version of partial-counts files; 1 is still read
+COUNTS_SUFFIX = ".counts.npz"   # sidecar holding the counts behind a model
+SMOOTHING = 0.1          # default constant added to every count
+RARE_COUNT = 5           # default count up to which words train the suffix model
+MAX_SUFFIX = 4           # default longest suffix the suffix model looks at
+SUFFIX_MIN_COUNT = 5     # rare tokens a signature needs to be kept
+
+WHITESPACE = re.compile(r"\s+")
+
+# An empty set of counts
+# tags and words list the strings by id; first_tags[word] is the id of the
+#   tag the word was first seen with, or -1 while it is unseen (only
+#   possible for the OOV word itself)
+def new_counts():
+    return {
+        "tags": [INIT_STATE, FINAL_STATE],
+        "tag_ids": {INIT_STATE: INIT_ID, FINAL_STATE: FINAL_ID},
+        "words": [OOV_WORD],
+        "word_ids": {OOV_WORD: OOV_ID},
+        "first_tags": array("i", [-1]),
+        "num_sentences": 0,
+        "bigrams": np.zeros((2, 2), dtype=np.int64),
+        "emission_keys": np.zeros(0, dtype=np.int64),
+        "emission_counts": np.zeros(0, dtype=np.int64),
+        "trigram_keys": np.zeros(0, dtype=np.int64),
+        "trigram_counts": np.zeros(0, dtype=np.int64),
+    }
+
+# Add two sparse (keys, counts) arrays, keeping the keys sorted and unique
+def merge_sparse(keys, counts, more_keys, more_counts):
+    (merged_keys, inverse) = np.unique(np.concatenate([keys, more_keys]), return_inverse=True)
+    merged_counts = np.bincount(inverse, weights=np.concatenate([counts, more_counts]),
+        minlength=len(merged_keys)).astype(np.int64)
+    return (merged_keys, merged_counts)
+
+# Add a batch of buffered ids to the counts
+# tag_stream holds each sentence as init, init, its tags, final; every
+#   window whose last element is not init lies inside one sentence
+def add_batch(counts, tag_stream, emission_tags, emission_words):
+    num_tags = len(counts["tags"])
+    if num_tags > TAG_MASK:
+        raise ValueError("Too many tags ({}) for {}-bit tag ids".format(num_tags, TAG_BITS))
+
+    bigrams = np.zeros((num_tags, num_tags), dtype=np.int64)
+    (old_rows, old_columns) = counts["bigrams"].shape
+    bigrams[:old_rows, :old_columns] = counts["bigrams"]
+    counts["bigrams"] = bigrams
+
+    stream = np.frombuffer(tag_stream, dtype=np.int32).astype(np.int64)
+    if len(stream) == 0:
+        return
+
+    (prev, tag) = (stream[:-1], stream[1:])
+    valid = tag != INIT_ID
+    bigrams += np.bincount(prev[valid] * num_tags + tag[valid],
+        minlength=num_tags * num_tags).reshape(num_tags, num_tags)
+
+    (prevprev, prev, tag) = (stream[:-2], stream[1:-1], stream[2:])
+    valid = tag != INIT_ID
+    keys = (prevprev[valid] << (2 * TAG_BITS)) | (prev[valid] << TAG_BITS) | tag[valid]
+    (keys, batch_counts) = np.unique(keys, return_counts=True)
+    (counts["trigram_keys"], counts["trigram_counts"]) = merge_sparse(
+        counts["trigram_keys"], counts["trigram_counts"], keys, batch_counts)
+
+    keys = (np.frombuffer(emission_words, dtype=np.int32).astype(np.int64) << TAG_BITS) \
+        | np.frombuffer(emission_tags, dtype=np.int32)
+    (keys, batch_counts) = np.unique(keys, return_counts=True)
+    (counts["emission_keys"], counts["emission_counts"]) = merge_sparse(
+        counts["emission_keys"], counts["emission_counts"], keys, batch_counts)
+
+# Count a tags file and a text file, line by line, into counts
+def count_corpus(tag_file, token_file, counts=None):
+    if counts is None:
+        counts = new_counts()
+    tag_ids = counts["tag_ids"]
+    word_ids = counts["word_ids"]
+    first_tags = counts["first_tags"]
+
+    tag_stream = array("i")
+    emission_tags = array("i")
+    emission_words = array("i")
 
-        prevtag = INIT_STATE
-        prevprevtag = INIT_STATE
+    for tag_string, token_string in zip(tag_file, token_file):
+        tags = WHITESPACE.split(tag_string.rstrip())
+        tokens = WHITESPACE.split(token_string.rstrip())
+        counts["num_sentences"] += 1
 
-        for (tag, token) in pairs:
+        tag_stream.append(INIT_ID)
+        tag_stream.append(INIT_ID)
+        for (tag, token) in zip(tags, tokens):
+            tag_id = tag_ids.get(tag)
+            if tag_id is None:
+                tag_id = tag_ids[tag] = len(counts["tags"])
+                counts["tags"].append(tag)
 
             # this block is a little trick to help with out-of-vocabulary (OOV)
             # words.  the first time we see *any* word token, we pretend it
             # is an OOV.  this lets our model decide the rate at which new
             # words of each POS-type should be expected (e.g., high for nouns,
             # low for determiners).
-            total_tags.add(tag)
-            if token not in vocab:
-                vocab[token] = 1
-                token = OOV_WORD
-
-            if tag not in emissions:
-                emissions[tag] = defaultdict(lambda: 0)
-            if prevtag not in bitransitions:
-                bitransitions[prevtag] = defaultdict(lambda: 0)
-            if prevprevtag not in tritransitions:
-                tritransitions[prevprevtag] = defaultdict(lambda: 0)
-            if prevtag not in tritransitions[prevprevtag]:
-                tritransitions[prevprevtag][prevtag] = defaultdict(lambda: 0)
-            if prevprevtag not in tritransitions_total:
-                tritransitions_total[prevprevtag] = defaultdict(lambda: 0)
-
-            # increment the emission/transition observation
-            emissions[tag][token] += 1
-            emissions_total[tag] += 1
-            
-            bitransitions[prevtag][tag] += 1
-            bitransitions_total[prevtag] += 1
-
-            tritransitions[prevprevtag][prevtag][tag] += 1
-            tritransitions_total[prevprevtag][prevtag] += 1
-
-            prevprevtag = prevtag
-            prevtag = tag
+            word_id = word_ids.get(token)
+            if word_id is None:
+                word_ids[token] = len(counts["words"])
+                counts["words"].append(token)
+                first_tags.append(tag_id)
+                word_id = OOV_ID
+            elif first_tags[word_id] < 0:
+                first_tags[word_id] = tag_id
+                word_id = OOV_ID
+
+            tag_stream.append(tag_id)
+            emission_tags.append(tag_id)
+            emission_words.append(word_id)
 
         # don't forget the stop probability for each sentence
-        if prevtag not in bitransitions:
-            bitransitions[prevtag] = defaultdict(lambda: 0)
-        if prevprevtag not in tritransitions:
-            tritransitions[prevprevtag] = defaultdict(lambda: 0)
-        if prevtag not in tritransitions[prevprevtag]:
-            tritransitions[prevprevtag][prevtag] = defaultdict(lambda: 0)
-        if prevprevtag not in tritransitions_total:
-            tritransitions_total[prevprevtag] = defaultdict(lambda: 0)
-
-        bitransitions[prevtag][FINAL_STATE] += 1
-        bitransitions_total[prevtag] += 1
-        tritransitions[prevprevtag][prevtag][FINAL_STATE] += 1
-        tritransitions_total[prevprevtag][prevtag] += 1
-
-# deleted interpolation calculation
-lambda1 = lambda2 = lambda3 = 0
-for a in tritransitions:
-    for b in tritransitions[a]:
-        for c in tritransitions[a][b]:
-            v = tritransitions[a][b][c]
-            if v > 0:
-                try:
-                    c1 = float(v-1)/(bitransitions[a][b]-1)
-                except ZeroDivisionError:
-                    c1 = 0
-                try:
-                    c2 = float(bitransitions[a][b]-1)/(emissions_total[a]-1)
-                except ZeroDivisionError:
-                    c2 = 0
-                try:
-                    c3 = float(emissions_total[a]-1)/(sum(emissions_total.values())-1)
-                except ZeroDivisionError:
-                    c3 = 0
-
-                k = max([c1, c2, c3])
-                if k == c1:
-                    lambda3 += v
-                if k == c2:
-                    lambda2 += v
-                if k == c3:
-                    lambda1 += v
-
-weights = [lambda1, lambda2, lambda3]
-norm_a = weights[0]/sum(weights)
-norm_b = weights[1]/sum(weights)
-norm_c = weights[2]/sum(weights)
-
-
-# Write output to output_file
-with open(OUTPUT_FILE, "w") as f:
-    num_bitrans_combos = len(total_tags)
-    for prevtag in total_tags:
-        for tag in total_tags:
-            if prevtag in bitransitions and tag in bitransitions[prevtag]:
-                f.write("bitrans {} {} {}\n"
-                    .format(prevtag, tag, (bitransitions[prevtag][tag]+0.1) / (bitransitions_total[prevtag]+num_bitrans_combos*0.1)))
-            elif prevtag in bitransitions:
-                f.write("bitrans {} {} {}\n"
-                    .format(prevtag, tag, (0.1) / (bitransitions_total[prevtag]+num_bitrans_combos*0.1)))
-            else:
-                f.write("bitrans {} {} {}\n"
-                    .format(prevtag, tag, (0.1) / (num_bitrans_combos*0.1)))
-
-    num_emissions_combos = len(set([token for tag in emissions for token in emissions[tag]]))
-    for tag in emissions:
-        for token in emissions[tag]:
-            f.write("emit {} {} {}\n"
-                .format(tag, token, (emissions[tag][token]+0.1) / (emissions_total[tag]+num_emissions_combos*0.1)))
-
-    num_tritrans_combos = sum([sum(tritransitions_total[prevprevtag].values()) for prevprevtag in tritransitions_total])
-    for prevprevtag in tritransitions:
-        for prevtag in tritransitions[prevprevtag]:
-            for tag in tritransitions[prevprevtag][prevtag]:
-                f.write("tritrans {} {} {} {}\n"
-                    .format(prevprevtag, prevtag, tag, (tritransitions[prevprevtag][prevtag][tag]+0.1) / (tritransitions_total[prevprevtag][prevtag]+num_tritrans_combos*0.1)))
-    f.write("norms {} {} {}\n".format(norm_a, norm_b, norm_c))
-
-    total_emissions = sum(emissions_total.values())
-    for tag in emissions_total:
-        if tag!="init":
-            f.write("unitag {} {}\n".format(tag, emissions_total[tag] / total_emissions))
+        tag_stream.append(FINAL_ID)
+
+        if len(tag_stream) >= BATCH_TOKENS:
+            add_batch(counts, tag_stream, emission_tags, emission_words)
+            tag_stream = array("i")
+            emission_tags = array("i")
+            emission_words = array("i")
+
+    add_batch(counts, tag_stream, emission_tags, emission_words)
+    return counts
+
+# Count a tags corpus and a text corpus (see corpus_cache.py) into counts,
+#   as count_corpus would count their text
+# Everything is done with array operations over the token ids: each tag
+#   and word type is looked up once, and the first-occurrence-as-OOV rule
+#   applies to the first position of each word new to the counts
+def count_corpus_cache(tag_corpus, token_corpus, counts=None):
+    if counts is None:
+        counts = new_counts()
+    tag_ids = counts["tag_ids"]
+    word_ids = counts["word_ids"]
+    first_tags = counts["first_tags"]
+
+    # Pair up tags and tokens sentence by sentence, as zip does
+    num_sentences = min(len(tag_corpus.offsets), len(token_corpus.offsets)) - 1
+    lengths = np.minimum(np.diff(tag_corpus.offsets[:num_sentences + 1]),
+        np.diff(token_corpus.offsets[:num_sentences + 1]))
+    token_starts = np.concatenate([[0], np.cumsum(lengths)])
+    sentence = np.repeat(np.arange(num_sentences), lengths)
+    position = np.arange(token_starts[-1]) - token_starts[sentence]
+    tag_types = tag_corpus.tokens[tag_corpus.offsets[sentence] + position]
+    token_types = token_corpus.tokens[token_corpus.offsets[sentence] + position]
+
+    # Look up the types that occur, in order of first occurrence
+    (types, first) = np.unique(tag_types, return_index=True)
+    tag_map = np.zeros(len(tag_corpus.vocab), dtype=np.int32)
+    for i in np.argsort(first):
+        tag = tag_corpus.vocab[types[i]]
+        tag_id = tag_ids.get(tag)
+        if tag_id is None:
+            tag_id = tag_ids[tag] = len(counts["tags"])
+            counts["tags"].append(tag)
+        tag_map[types[i]] = tag_id
+    emission_tags = tag_map[tag_types]
+
+    (types, first) = np.unique(token_types, return_index=True)
+    word_map = np.zeros(len(token_corpus.vocab), dtype=np.int32)
+    new_positions = array("q")
+    for i in np.argsort(first):
+        token = token_corpus.vocab[types[i]]
+        word_id = word_ids.get(token)
+        if word_id is None:
+            word_id = word_ids[token] = len(counts["words"])
+            counts["words"].append(token)
+            first_tags.append(int(emission_tags[first[i]]))
+            new_positions.append(first[i])
+        elif first_tags[word_id] < 0:
+            first_tags[word_id] = int(emission_tags[first[i]])
+            new_positions.append(first[i])
+        word_map[types[i]] = word_id
+    emission_words = word_map[token_types]
+    emission_words[np.frombuffer(new_positions, dtype=np.int64)] = OOV_ID
+
+    # Lay the sentences out as init, init, tags, final
+    stream_starts = token_starts + 3 * np.arange(num_sentences + 1)
+    tag_stream = np.full(stream_starts[-1], INIT_ID, dtype=np.int32)
+    tag_stream[stream_starts[sentence] + 2 + position] = emission_tags
+    tag_stream[stream_starts[:-1] + 2 + lengths] = FINAL_ID
+    counts["num_sentences"] += num_sentences
+
+    # Add whole sentences at a time, about BATCH_TOKENS at once
+    bounds = np.unique(np.append(
+        np.searchsorted(stream_starts, np.arange(0, stream_starts[-1], BATCH_TOKENS)), num_sentences))
+    for (start, stop) in zip(bounds[:-1], bounds[1:]):
+        add_batch(counts, tag_stream[stream_starts[start]:stream_starts[stop]],
+            emission_tags[token_starts[start]:token_starts[stop]],
+            emission_words[token_starts[start]:token_starts[stop]])
+    add_batch(counts, array("i"), array("i"), array("i"))
+    return counts
+
+# Strings go into a counts file as one array of UTF-8 bytes joined by
+#   newlines, which no token holds, so a single long token does not widen
+#   every entry as a fixed-width string array would
+def pack_strings(strings):
+    return np.frombuffer("\n".join(strings).encode("utf-8"), dtype=np.uint8)
+
+def unpack_strings(packed):
+    return packed.tobytes().decode("utf-8").split("\n")
+
+# Save counts to a partial-counts file that merge_counts can combine
+def save_counts(counts, path):
+    with open(path, "wb") as f:
+        np.savez(f,
+            version=np.array(COUNTS_VERSION),
+            tags=pack_strings(counts["tags"]),
+            words=pack_strings(counts["words"]),
+            first_tags=np.frombuffer(counts["first_tags"], dtype=np.int32),
+            num_sentences=np.array(counts["num_sentences"]),
+            bigrams=counts["bigrams"],
+            emission_keys=counts["emission_keys"],
+            emission_counts=counts["emission_counts"],
+            trigram_keys=counts["trigram_keys"],
+            trigram_counts=counts["trigram_counts"])
+
+def load_counts(path):
+    with np.load(path) as data:
+        version = int(data["version"])
+        if version not in (1, COUNTS_VERSION):
+            raise ValueError("{} has counts format version {}, expected {}"
+                .format(path, version, COUNTS_VERSION))
+        counts = new_counts()
+        # Version 1 held the strings as fixed-width string arrays
+        if version == 1:
+            (counts["tags"], counts["words"]) = (data["tags"].tolist(), data["words"].tolist())
+        else:
+            (counts["tags"], counts["words"]) = (unpack_strings(data["tags"]), unpack_strings(data["words"]))
+        counts["tag_ids"] = {tag: i for (i, tag) in enumerate(counts["tags"])}
+        counts["word_ids"] = {word: i for (i, word) in enumerate(counts["words"])}
+        counts["first_tags"] = array("i", data["first_tags"].tobytes())
+        counts["num_sentences"] = int(data["num_sentences"])
+        for name in ("bigrams", "emission_keys", "emission_counts", "trigram_keys", "trigram_counts"):
+            counts[name] = data[name]
+    return counts
+
+# Combine the counts of two consecutive pieces of a corpus, earlier first,
+#   into the counts sequential training over both would have produced
+# The only order-dependent count is the first-occurrence-as-OOV rule: when
+#   the earlier piece has already seen a word, the emission the later piece
+#   counted as OOV for that word's first occurrence belongs to the word
+def merge_counts(earlier, later):
+    merged = {
+        "tags": list(earlier["tags"]),
+        "tag_ids": dict(earlier["tag_ids"]),
+        "words": list(earlier["words"]),
+        "word_ids": dict(earlier["word_ids"]),
+        "first_tags": array("i", earlier["first_tags"]),
+        "num_sentences": earlier["num_sentences"] + later["num_sentences"],
+    }
+
+    # Map the later ids onto the merged ids, appending new tags and words
+    tag_map = np.zeros(len(later["tags"]), dtype=np.int64)
+    for (i, tag) in enumerate(later["tags"]):
+        if tag not in merged["tag_ids"]:
+            merged["tag_ids"][tag] = len(merged["tags"])
+            merged["tags"].append(tag)
+        tag_map[i] = merged["tag_ids"][tag]
+
+    word_map = np.zeros(len(later["words"]), dtype=np.int64)
+    moved_words = array("i")
+    moved_tags = array("i")
+    for (i, word) in enumerate(later["words"]):
+        first_tag = later["first_tags"][i]
+        first_tag = -1 if first_tag < 0 else int(tag_map[first_tag])
+        word_id = merged["word_ids"].get(word)
+        if word_id is None:
+            word_id = merged["word_ids"][word] = len(merged["words"])
+            merged["words"].append(word)
+            merged["first_tags"].append(first_tag)
+        elif merged["first_tags"][word_id] < 0:
+            merged["first_tags"][word_id] = first_tag
+        elif first_tag >= 0:
+            moved_words.append(word_id)
+            moved_tags.append(first_tag)
+        word_map[i] = word_id
+
+    num_tags = len(merged["tags"])
+    if num_tags > TAG_MASK:
+        raise ValueError("Too many tags ({}) for {}-bit tag ids".format(num_tags, TAG_BITS))
+
+    merged["bigrams"] = np.zeros((num_tags, num_tags), dtype=np.int64)
+    (rows, columns) = earlier["bigrams"].shape
+    merged["bigrams"][:rows, :columns] = earlier["bigrams"]
+    np.add.at(merged["bigrams"], (tag_map[:, np.newaxis], tag_map[np.newaxis, :len(later["bigrams"])]),
+        later["bigrams"])
+
+    keys = later["trigram_keys"]
+    keys = (tag_map[keys >> (2 * TAG_BITS)] << (2 * TAG_BITS)) \
+        | (tag_map[(keys >> TAG_BITS) & TAG_MASK] << TAG_BITS) | tag_map[keys & TAG_MASK]
+    order = np.argsort(keys)
+    (merged["trigram_keys"], merged["trigram_counts"]) = merge_sparse(
+        earlier["trigram_keys"], earlier["trigram_counts"], keys[order], later["trigram_counts"][order])
+
+    # Move the misattributed first occurrences from OOV back to their words
+    moved_words = np.frombuffer(moved_words, dtype=np.int32).astype(np.int64)
+    moved_tags = np.frombuffer(moved_tags, dtype=np.int32).astype(np.int64)
+    keys = later["emission_keys"]
+    keys = np.concatenate([
+        (word_map[keys >> TAG_BITS] << TAG_BITS) | tag_map[keys & TAG_MASK],
+        (OOV_ID << TAG_BITS) | moved_tags,
+        (moved_words << TAG_BITS) | moved_tags])
+    more_counts = np.concatenate([
+        later["emission_counts"],
+        np.full(len(moved_tags), -1, dtype=np.int64),
+        np.ones(len(moved_tags), dtype=np.int64)])
+    (keys, counts) = merge_sparse(earlier["emission_keys"], earlier["emission_counts"], keys, more_counts)
+    nonzero = counts != 0
+    (merged["emission_keys"], merged["emission_counts"]) = (keys[nonzero], counts[nonzero])
+
+    return merged
+
+# Byte offsets at which the given line numbers (0-based, ascending) start
+# Lines are found by scanning for newline bytes in large blocks; line
+#   numbers past the end of the file map to its size
+def line_offsets(path, line_numbers):
+    wanted = collections.deque(line_numbers)
+    offsets = []
+    (lines_before, position) = (0, 0)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(SCAN_BLOCK_SIZE), b""):
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+            while wanted and (wanted[0] == 0 or wanted[0] - 1 - lines_before < len(newlines)):
+                line = wanted.popleft()
+                offsets.append(0 if line == 0 else position + int(newlines[line - 1 - lines_before]) + 1)
+            lines_before += len(newlines)
+            position += len(block)
+    return offsets + [position] * len(wanted)
+
+# Number of lines in a file, counting a final line without a newline
+def count_lines(path):
+    (num_lines, last) = (0, b"\n")
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(SCAN_BLOCK_SIZE), b""):
+            num_lines += block.count(b"\n")
+            last = block[-1:]
+    return num_lines + (last != b"\n")
+
+# Open a text file for reading from a byte offset; closing it closes the
+#   underlying binary file too
+def open_at(path, offset):
+    raw = open(path, "rb")
+    raw.seek(offset)
+    return io.TextIOWrapper(raw)
+
+# Map step: count one line range of the paired files into a partial-counts
+#   file
+def count_shard(tag_path, token_path, tag_offset, token_offset, num_lines, counts_path):
+    with open_at(tag_path, tag_offset) as tag_file, open_at(token_path, token_offset) as token_file:
+        tag_lines = itertools.islice(tag_file, num_lines)
+        token_lines = itertools.islice(token_file, num_lines)
+        save_counts(count_corpus(tag_lines, token_lines), counts_path)
+    return counts_path
+
+# Split the paired files into line ranges, count them on a process pool
+#   and merge the partial counts in corpus order
+# Shard boundaries are found at newline bytes, so files must not use bare
+#   carriage returns as line breaks
+def count_sharded(tag_path, token_path, num_shards, workers, counts_dir):
+    num_lines = min(count_lines(tag_path), count_lines(token_path))
+    starts = [num_lines * i // num_shards for i in range(num_shards + 1)]
+    tag_offsets = line_offsets(tag_path, starts)
+    token_offsets = line_offsets(token_path, starts)
+
+    tasks = [(tag_path, token_path, tag_offsets[i], token_offsets[i], starts[i + 1] - starts[i],
+        os.path.join(counts_dir, "shard-{:05d}.npz".format(i))) for i in range(num_shards)]
+    with multiprocessing.Pool(workers) as pool:
+        paths = pool.starmap(count_shard, tasks)
+
+    counts = new_counts()
+    for path in paths:
+        counts = merge_counts(counts, load_counts(path))
+    return counts
+
+# Unpack sparse keys into their tag (or word) id columns, outermost first
+def unpack_keys(keys, num_fields):
+    return [keys >> (TAG_BITS * (num_fields - 1))] + \
+        [(keys >> (TAG_BITS * shift)) & TAG_MASK for shift in range(num_fields - 2, -1, -1)]
+
+# Deleted-interpolation weights (norm_a, norm_b, norm_c) for the unigram,
+#   bigram and trigram terms, computed over all observed trigrams at once
+# Each trigram's count goes to the weight(s) whose ratio is largest; a
+#   ratio with a zero denominator counts as 0
+def interpolation_weights(counts, emissions_total):
+    (a, b, c) = unpack_keys(counts["trigram_keys"], 3)
+    v = counts["trigram_counts"]
+    bigram_ab = counts["bigrams"][a, b]
+    emissions_a = emissions_total[a]
+    total_emissions = emissions_total.sum()
+
+    def ratio(numerator, denominator):
+        denominator = denominator.astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(denominator != 0, numerator / denominator, 0.0)
+
+    c1 = ratio(v - 1, bigram_ab - 1)
+    c2 = ratio(bigram_ab - 1, emissions_a - 1)
+    c3 = ratio(emissions_a - 1, np.full(len(v), total_emissions - 1))
+    k = np.maximum(np.maximum(c1, c2), c3)
+
+    weights = [int(v[k == c3].sum()), int(v[k == c2].sum()), int(v[k == c1].sum())]
+    return tuple(weight / sum(weights) for weight in weights)
+
+# Estimate the suffix model of unknown words from the rare words, those
+#   seen at most rare_count times (counting the occurrence that went to OOV)
+# Returns the signatures kept, in sorted order, the (signature, tag, P(tag |
+#   signature)) entries of each, and theta, the standard deviation of the
+#   tag unigram probabilities, which weighs each signature's distribution
+#   against that of the signature one step less specific when decoding
+# word_shapes.ALL_RARE holds the tag distribution of all rare words
+def estimate_suffixes(counts, emission_words, emission_tags, emission_counts, emissions_total,
+        rare_count, max_suffix):
+    first_tags = np.frombuffer(counts["first_tags"], dtype=np.int32)
+    num_words = len(counts["words"])
+    totals = np.bincount(emission_words, weights=emission_counts, minlength=num_words) + (first_tags >= 0)
+    rare = totals <= rare_count
+    rare[OOV_ID] = False
+
+    # Tag counts of every rare word, including its first occurrence
+    entries = rare[emission_words] & (emission_words != OOV_ID)
+    words = np.concatenate([emission_words[entries], np.flatnonzero(rare & (first_tags >= 0))])
+    tags = np.concatenate([emission_tags[entries], first_tags[rare & (first_tags >= 0)]])
+    weights = np.concatenate([emission_counts[entries], np.ones(len(words) - entries.sum(), dtype=np.int64)])
+
+    # Each rare word's counts go to all of its signatures
+    signature_ids = {word_shapes.ALL_RARE: 0}
+    word_signature_ids = {}
+    for word in np.unique(words).tolist():
+        word_signature_ids[word] = [0] + [signature_ids.setdefault(signature, len(signature_ids))
+            for signature in word_shapes.word_signatures(counts["words"][word], max_suffix)]
+    repeats = np.array([len(word_signature_ids[word]) for word in words.tolist()], dtype=np.intp)
+    signatures = np.array([i for word in words.tolist() for i in word_signature_ids[word]], dtype=np.int64)
+    keys = (signatures << TAG_BITS) | np.repeat(tags, repeats)
+    (keys, inverse) = np.unique(keys, return_inverse=True)
+    key_counts = np.bincount(inverse, weights=np.repeat(weights, repeats)).astype(np.int64)
+    (key_signatures, key_tags) = unpack_keys(keys, 2)
+
+    signature_totals = np.bincount(key_signatures, weights=key_counts, minlength=len(signature_ids))
+    kept = signature_totals[key_signatures] >= SUFFIX_MIN_COUNT
+    signature_list = np.array(list(signature_ids), dtype=object)
+    probs = key_counts[kept] / signature_totals[key_signatures[kept]]
+
+    unigram = emissions_total[emissions_total > 0] / emissions_total.sum()
+    theta = float(np.std(unigram, ddof=1)) if len(unigram) > 1 else 1.0
+    return (signature_list[key_signatures[kept]], key_tags[kept], probs, theta)
+
+# Compute the add-smoothing probabilities and deleted-interpolation weights
+#   from counts as arrays, with entries in tag (then word) order so the
+#   output does not depend on how the corpus was counted
+def estimate(counts, smoothing=SMOOTHING, rare_count=RARE_COUNT, max_suffix=MAX_SUFFIX):
+    tags = np.array(counts["tags"], dtype=object)
+    words = np.array(counts["words"], dtype=object)
+    num_tags = len(tags)
+    tag_rank = np.argsort(np.argsort(tags.astype(str), kind="stable"))
+    bigrams = counts["bigrams"]
+
+    (emission_words, emission_tags) = unpack_keys(counts["emission_keys"], 2)
+    emission_counts = counts["emission_counts"]
+    emissions_total = np.zeros(num_tags, dtype=np.int64)
+    np.add.at(emissions_total, emission_tags, emission_counts)
+
+    order = np.argsort(tag_rank)
+    bitrans = (bigrams + smoothing) / (bigrams.sum(axis=1)[:, np.newaxis] + num_tags*smoothing)
+
+    num_emissions_combos = len(np.unique(emission_words))
+    emit = (emission_counts + smoothing) / (emissions_total[emission_tags] + num_emissions_combos*smoothing)
+    word_rank = np.argsort(np.argsort(words.astype(str), kind="stable"))
+    emission_order = np.lexsort((word_rank[emission_words], tag_rank[emission_tags]))
+
+    trigram_keys = counts["trigram_keys"]
+    trigram_counts = counts["trigram_counts"]
+    (contexts, context_index) = np.unique(trigram_keys >> TAG_BITS, return_inverse=True)
+    tritransitions_total = np.bincount(context_index, weights=trigram_counts,
+        minlength=len(contexts)).astype(np.int64)
+    num_tritrans_combos = int(trigram_counts.sum())
+    tritrans = (trigram_counts + smoothing) / (tritransitions_total[context_index] + num_tritrans_combos*smoothing)
+    (a, b, c) = unpack_keys(trigram_keys, 3)
+    trigram_order = np.lexsort((tag_rank[c], tag_rank[b], tag_rank[a]))
+
+    unigram_tags = order[emissions_total[order] > 0]
+
+    (suffix_signatures, suffix_tags, suffix_probs, theta) = estimate_suffixes(counts,
+        emission_words, emission_tags, emission_counts, emissions_total, rare_count, max_suffix)
+    suffix_order = np.lexsort((tag_rank[suffix_tags], suffix_signatures.astype(str)))
+
+    return {
+        "tags": tags,
+        "words": words,
+        "tag_order": order,
+        "bitrans": bitrans[np.ix_(order, order)],
+        "emissions": (emission_tags[emission_order], emission_words[emission_order], emit[emission_order]),
+        "trigrams": (a[trigram_order], b[trigram_order], c[trigram_order], tritrans[trigram_order]),
+        "norms": interpolation_weights(counts, emissions_total),
+        "unigrams": (unigram_tags, emissions_total[unigram_tags] / emissions_total.sum()),
+        "suffixes": (suffix_signatures[suffix_order], suffix_tags[suffix_order], suffix_probs[suffix_order]),
+        "suffix_norms": (theta, max_suffix),
+    }
+
+# Write counts to output_file as a text HMM
+# Lines of each kind are formatted in one pass and written at once
+def write_model(counts, output_file, smoothing=SMOOTHING, rare_count=RARE_COUNT, max_suffix=MAX_SUFFIX):
+    model = estimate(counts, smoothing, rare_count, max_suffix)
+    tags = model["tags"]
+    ordered_tags = tags[model["tag_order"]]
+    num_tags = len(tags)
+
+    with open(output_file, "w") as f:
+        f.write("".join(map("bitrans {} {} {}\n".format,
+            np.repeat(ordered_tags, num_tags), np.tile(ordered_tags, num_tags),
+            model["bitrans"].ravel().tolist())))
+
+        (emission_tags, emission_words, emit) = model["emissions"]
+        f.write("".join(map("emit {} {} {}\n".format,
+            tags[emission_tags], model["words"][emission_words], emit.tolist())))
+
+        (a, b, c, tritrans) = model["trigrams"]
+        f.write("".join(map("tritrans {} {} {} {}\n".format,
+            tags[a], tags[b], tags[c], tritrans.tolist())))
+
+        f.write("norms {} {} {}\n".format(*model["norms"]))
+
+        (unigram_tags, unigram) = model["unigrams"]
+        f.write("".join(map("unitag {} {}\n".format, tags[unigram_tags], unigram.tolist())))
+
+        (signatures, suffix_tags, suffix_probs) = model["suffixes"]
+        if len(signatures):
+            f.write("".join(map("suffix {} {} {}\n".format,
+                signatures, tags[suffix_tags], suffix_probs.tolist())))
+            f.write("suffixnorm {} {}\n".format(*model["suffix_norms"]))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train an HMM from tagged text.")
+    parser.add_argument("tag_file")
+    parser.add_argument("token_file")
+    parser.add_argument("output_file")
+    parser.add_argument("--shards", type=int, default=1,
+        help="split the corpus into this many line ranges counted in parallel (default: 1)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+        help="processes counting shards (default: number of CPUs)")
+    parser.add_argument("--counts-dir", default=None,
+        help="directory to keep the partial-counts files in (default: a temporary directory)")
+    parser.add_argument("--counts-file", default=None,
+        help="sidecar file holding the raw counts behind the model (default: hmm-file.counts.npz)")
+    parser.add_argument("--smoothing", type=float, default=SMOOTHING,
+        help="constant added to every count (default: {})".format(SMOOTHING))
+    parser.add_argument("--rare-count", type=int, default=RARE_COUNT, metavar="K",
+        help="words seen at most K times train the suffix model of unknown words, 0 for none "
+            "(default: {})".format(RARE_COUNT))
+    parser.add_argument("--max-suffix", type=int, default=MAX_SUFFIX, metavar="N",
+        help="longest suffix the suffix model looks at (default: {})".format(MAX_SUFFIX))
+    parser.add_argument("--update", action="store_true",
+        help="add the counts of the given files to those in the counts file instead of starting afresh")
+    args = parser.parse_args()
+    if args.smoothing <= 0:
+        parser.error("--smoothing must be positive, or unseen events get no probability")
+    if args.counts_file is None:
+        args.counts_file = args.output_file + COUNTS_SUFFIX
+    if args.update and not os.path.exists(args.counts_file):
+        parser.error("--update needs existing counts, but {} does not exist".format(args.counts_file))
+    args.cached = corpus_cache.is_corpus(args.tag_file) or corpus_cache.is_corpus(args.token_file)
+    if args.cached and args.shards > 1:
+        parser.error("--shards splits text files; corpus caches are counted in one pass")
+    return args
+
+def main():
+    args = parse_args()
+
+    t0 = time.time()
+    if args.shards > 1:
+        with contextlib.ExitStack() as stack:
+            counts_dir = args.counts_dir
+            if counts_dir is None:
+                counts_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            os.makedirs(counts_dir, exist_ok=True)
+            counts = count_sharded(args.tag_file, args.token_file, args.shards, args.workers, counts_dir)
+    elif args.cached:
+        counts = count_corpus_cache(corpus_cache.open_corpus(args.tag_file),
+            corpus_cache.open_corpus(args.token_file))
+    else:
+        with open(args.tag_file) as tag_file, open(args.token_file) as token_file:
+            counts = count_corpus(tag_file, token_file)
+
+    # The new files come after everything already counted
+    if args.update:
+        counts = merge_counts(load_counts(args.counts_file), counts)
+
+    # Write both files in full before replacing either, sidecar first, so an
+    #   interrupted run leaves the old model and counts intact rather than a
+    #   new model next to stale counts
+    partial_model = args.output_file + ".partial"
+    partial_counts = args.counts_file + ".partial"
+    write_model(counts, partial_model, args.smoothing, args.rare_count, args.max_suffix)
+    save_counts(counts, partial_counts)
+    os.replace(partial_counts, args.counts_file)
+    os.replace(partial_model, args.output_file)
+    t1 = time.time()
+
+    # ru_maxrss is in kilobytes on Linux
+    print("Trained on {} lines with {} tags and {} words".format(
+        counts["num_sentences"], len(counts["tags"]), len(counts["words"])))
+    print("Peak memory: {:.1f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    if args.shards > 1:
+        print("Peak memory of largest worker: {:.1f} MB".format(
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024))
+    print("Time taken to run: {}".format(t1 - t0))
 
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,64 @@ Ze Xuan Ong
 Jocelyn Huang
 Noah A. Smith
 
-Usage: python viterbi.py <HMM_FILE> <TEXT_FILE> <OUTPUT_FILE>
+Usage: python viterbi.py [--workers N] [--trigram] [--beam K [--compare-exact]]
+                         [--batch-size N] [--nbest N [--nbest-format jsonl|tsv]] [--stream]
+                         [--instrument FILE] [--profile FILE]
+                         <HMM_FILE> <TEXT_FILE> <OUTPUT_FILE>
+
+With --workers N the input is split into chunks that are decoded on a
+pool of N processes, each of which loads the HMM file once.
+
+With --trigram sentences are decoded with the second-order model using
+the deleted-interpolation weights from the norms line, falling back to
+the bigram decoder for sentences it cannot tag.
+
+With --beam K only the K best states (or state pairs for --trigram) are
+kept at each word. --compare-exact additionally decodes the input with
+exact Viterbi and prints how often the two disagree, to help choose K.
+
+With --batch-size N sentences are sorted by length and decoded N at a
+time, running each step of the recursion for the whole batch in one set
+of array operations; this is much faster on many short sentences and
+gives the same tags as sentence-by-sentence decoding.
+
+With --nbest N the N best tag sequences of each sentence are written
+with their log probabilities instead of the single best one, for the
+bigram or (with --trigram) the trigram model. The jsonl format writes one
+line per sentence holding a JSON list of {"score", "tags"} objects, best
+first; tsv writes one "score<TAB>tags" line per sequence and a blank line
+after each sentence.
+
+With --stream the input is read lazily and each tag line is written as
+soon as it is decoded, so memory stays bounded on very large inputs.
+TEXT_FILE and OUTPUT_FILE may be "-" for stdin and stdout, in which
+case the summary lines go to stderr.
+
+HMM_FILE may be either the text format written by train_hmm.py or a
+binary file written by compile_hmm.py, which is memory-mapped.
+
+Models written with a suffix model give every word shape and suffix
+signature of it an emission row after the words when they are loaded.
+A word not in the vocabulary is tagged with the row of its longest
+signature found in the signature index, and falls back to the OOV row if
+none is; the rows of recent unknown words are kept in an LRU cache.
+
+TEXT_FILE may be a corpus cache written by corpus_cache.py, whose token
+ids are mapped onto the model's word indices with one lookup per type
+and decoded in batches (of BATCH_SIZE unless --batch-size is given).
+
+With --instrument FILE (or VITERBI_INSTRUMENT=FILE in the environment)
+the run is instrumented and a JSON report is written to FILE at exit:
+the time spent in each phase (loading, input, recursion, backtrace,
+output), counts of tokens, OOV tokens, sentences, state transitions
+scored by the recursion and transitions skipped because a state is not a
+candidate of its word or fell out of the beam, and a histogram of the
+time taken to decode each sentence (in batches, each sentence counts the
+batch's time per sentence). With workers the phase times and
+counts inside the decoders, and the model load of each worker, are
+summed over the workers. --profile FILE
+(or VITERBI_PROFILE=FILE) runs the program under cProfile and writes
+the statistics to FILE for pstats or snakeviz.
 
 Apart from writing the output to a file, the program also prints
 the number of text lines read and processed, and the time taken
@@ -12,29 +69,54 @@ for the entire program to run in seconds. This may be useful to
 let you know how much time you have to get a coffee in subsequent
 iterations.
 
+Requires NumPy.
+
 """
 
+import argparse
+import collections
+import contextlib
+import cProfile
+import functools
+import json
 import math
+import mmap
+import multiprocessing
+import os
 import sys
 import time
 import itertools
 
+import numpy as np
+
+from array import array
 from collections import defaultdict
 
+import corpus_cache
+import word_shapes
+
 # Magic strings and numbers
-HMM_FILE = sys.argv[1]
-TEXT_FILE = sys.argv[2]
-OUTPUT_FILE = sys.argv[3]
 BIGRAM_TRANSITION_TAG = "bitrans"
 TRIGRAM_TRANSITION_TAG = "tritrans"
 NORM_TAG = "norms"
 EMISSION_TAG = "emit"
 UNIGRAM_TAG = "unitag"
+SUFFIX_TAG = "suffix"
+SUFFIX_NORM_TAG = "suffixnorm"
 OOV_WORD = "OOV"         # check that the HMM file uses this same string
 INIT_STATE = "init"      # check that the HMM file uses this same string
 FINAL_STATE = "final"    # check that the HMM file uses this same string
+CHUNKS_PER_WORKER = 4    # more chunks than workers evens out sentence lengths
+SENTENCE_CACHE_SIZE = 10000   # default number of decoded sentences kept
+WORD_CACHE_SIZE = 100000      # number of per-word emission vectors kept
+STREAM_CHUNK_SIZE = 64   # lines per chunk sent to a worker with --stream
+BATCH_SIZE = 64          # sentences decoded together by batch_viterbi
+COMPILED_MAGIC = b"HMMC0001"   # first bytes of a file written by compile_hmm.py
+COMPILED_ALIGNMENT = 64        # byte alignment of each array in a compiled file
+INSTRUMENT_ENV = "VITERBI_INSTRUMENT"   # report file; setting it turns instrumentation on
+PROFILE_ENV = "VITERBI_PROFILE"         # cProfile statistics file
 
-# Transition and emission probabilities
+# Transition probabilities
 # Structured as a nested defaultdict in defaultdict, with inner defaultdict
 #   returning 0.0 as a default value, since dirty KeyErrors are equivalent to
 #   zero probabilities
@@ -42,188 +124,668 @@ FINAL_STATE = "final"    # check that the HMM file uses this same string
 # The advantage of this is that one can add redundant transition probabilities
 bitransition = defaultdict(lambda: defaultdict(lambda: 1.0))
 tritransition = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: 1.0)))
-emission = defaultdict(lambda: defaultdict(lambda: 1.0))
 uniform = defaultdict(lambda: 0.0)
 
+# Emission entries of a text model as parallel flat arrays, one entry per
+#   emit line: the word's id in vocab, the state and the log probability
+# There is one entry per word and state the model emits, however large the
+#   vocabulary, and they are freed once compiled into the sparse table
+emission_words = array("i")
+emission_tags = []
+emission_probs = array("d")
+
+# Entries of the suffix model of unknown words, one per suffix line: the
+#   signature, the state and P(state | signature) over rare words
+# suffix_theta weighs each signature against the one less specific, and
+#   suffix_length is the longest suffix used in signatures
+suffix_signatures = []
+suffix_tags = []
+suffix_probs = array("d")
+suffix_theta = None
+suffix_length = 0
+
 # Store states to iterate over for HMM
-# Store vocab to check for OOV words
+# Store vocab to check for OOV words, with each word's id in emission_words
 states = set()
-state_pairs = set()
-vocab = set()
+vocab = {}
 norm_a = norm_b = norm_c = None
 
-# original bigram viterbi algorithm
-def bigram_viterbi(index, line):
-    words = line.split()
+# Log-probability tables, compiled from the dicts and entries above by
+#   compile_model() or mapped from a compiled file, and made current by
+#   install_model()
+# States and words are mapped to integer indices so that each step of the
+#   bigram recursion is a single broadcasted max/argmax over an S x S matrix
+# Impossible transitions are stored as -inf so they can never win a max,
+#   which replaces the "move on" checks of the dict version
+tags = []
+tag_index = {}
+words = []
+word_index = {}
+signatures = []
+signature_index = {}
+max_suffix = 0
+oov_index = None
+init_index = final_index = None
+log_bitransition = None     # [prev_state, state]
+log_unigram = None          # [state]
+tritransition_index = None  # [entry, (prev_prev_state, prev_state, state)]
+log_tritransition = None    # [entry]
+log_interpolation = None    # [prev_prev_state, prev_state, state]
 
-    # Setup Viterbi for this sentence:
-    # V[x][y] where x is the index of the word in the line
-    #   and y is a state in the set of states
-    V = defaultdict(lambda: {})
+# Sparse emission table, which is also the tag dictionary, in CSR form by
+#   word: the candidates of word index x are the ascending state indices
+#   emission_states[emission_offsets[x]:emission_offsets[x + 1]], with
+#   their emission log probabilities at the same positions of
+#   emission_scores
+# Only non-zero emissions are stored, so the table grows with the entries
+#   of the model rather than with tags x vocabulary, and a lookup never
+#   adds to it
+# The OOV entry holds the open-class states the model emitted OOV for
+# Models with a suffix model have a row per signature after the words,
+#   holding the OOV entry reweighted by that signature; unknown words are
+#   looked up by word_row()
+# All decoders only run their recursion over these candidates
+emission_offsets = None     # [word + 1]
+emission_states = None      # [entry]
+emission_scores = None      # [entry]
 
-    # Initialize backtrace so we get recover the path:
-    # back[x][y] where x is the index of the word in the line
-    #   and y is the previous state with the highest probability
-    back = defaultdict(lambda: defaultdict(lambda: ""))
+# LRU cache of decoded sentences keyed by decoder settings and the token
+#   sequence with unknown words replaced by OOV, since those decode the same
+# Hit and miss counts for this and the word_emissions cache are kept in
+#   cache_stats for the end-of-run report
+sentence_cache = collections.OrderedDict()
+sentence_cache_size = SENTENCE_CACHE_SIZE
+cache_stats = collections.Counter()
 
-    # Initialize V with init state
-    # REDUNDANT
-    V[-1][INIT_STATE] = 0.0
+# Instrumentation, off unless --instrument or VITERBI_INSTRUMENT is given
+# instrument_stats holds seconds spent per phase under "time." keys, event
+#   counts under "count." keys and the per-sentence latency histogram under
+#   "latency." keys, one per power-of-two bucket of microseconds; like
+#   cache_stats it is a Counter so worker deltas add up in the main process
+# The counters in the decoders cost a branch per word when off
+instrumented = False
+instrument_stats = collections.Counter()
 
-    # Iterate over each word in the line
-    for i in range(len(words)):
+# The part of instrument_stats a worker has already sent back with a chunk,
+#   so the first chunk also carries the worker's model load
+instrument_sent = collections.Counter()
 
-        # If word not in vocab, replace with OOV word
-        if words[i] not in vocab:
-            words[i] = OOV_WORD
+# Add the time spent in the with block to a phase when instrumented
+@contextlib.contextmanager
+def phase(name):
+    if not instrumented:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        instrument_stats["time." + name] += time.perf_counter() - t0
 
-        # Iterate over all possible current states:
-        for state in states:
+# Count the latency of one sentence in its histogram bucket, keyed by the
+#   bucket's upper bound in microseconds; batch decoders count each of
+#   their sentences at the batch's time per sentence
+def record_latency(seconds, sentences=1):
+    instrument_stats["latency.{}".format(1 << int(seconds * 1e6).bit_length())] += sentences
 
-            # If this emission is impossible for this state, move on
-            emission_prob = emission[state][words[i]]
-            if emission_prob > 0.0 or emission_prob == 1.0:
-                continue
+# Yield the items of an iterable, adding the time spent waiting for each
+#   to a phase when instrumented
+def timed_iter(name, iterable):
+    if not instrumented:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            item = next(iterator, timed_iter)
+        if item is timed_iter:
+            return
+        yield item
 
-            # Iterate over all possible previous states:
-            # Specifically, prev_state -> state
-            for prev_state in states:
-
-                # If this transition is impossible for this state, move on
-                bitransition_prob = bitransition[prev_state][state]
-                if bitransition_prob > 0.0 or bitransition_prob == 1.0:
-                    continue
-
-                # Calculate the (log) probability of:
-                # 1. The highest probability of the previous state being pre_state
-                # 2. The probability of transition prev_state -> state
-                # 3. The probability of emission state -> words[i]
-                try:
-                    v = V[i - 1][prev_state] + bitransition_prob + emission_prob
-                except KeyError as e:
-                    continue
-
-                # Replace if probability is higher
-                current = V[i].get(state, None)
-                if not current or v > V[i][state]:
-                    V[i][state] = v
-                    back[i][state] = prev_state
-
-    # Handle final state    
-    best_final_state = None
-    for state in states:
-        bitransition_prob = bitransition[state][FINAL_STATE]
-        if bitransition_prob >= 0:
-            continue
+# Count the tokens and OOV tokens of a sentence of word indices
+def count_tokens(indices):
+    instrument_stats["count.sentences"] += 1
+    instrument_stats["count.tokens"] += len(indices)
+    instrument_stats["count.oov_tokens"] += sum(1 for i in indices if i >= len(words) or i == oov_index)
+
+# Build the tables of the parsed text model: dense transition arrays from
+#   the bitransition dicts and the sparse CSR emission table from the
+#   emission arrays
+def compile_model():
+    tag_list = sorted(states)
+    tag_ids = {state: i for (i, state) in enumerate(tag_list)}
+
+    # The OOV row always exists so unknown words need no special casing;
+    #   if the HMM file never emits OOV the row is simply empty
+    word_list = sorted(vocab.keys() | {OOV_WORD})
+    word_ids = {word: i for (i, word) in enumerate(word_list)}
+
+    bitransitions = np.full((len(tag_list), len(tag_list)), -np.inf)
+    for (prev_state, row) in bitransition.items():
+        for (state, prob) in row.items():
+            # Skip the 1.0 placeholders inserted by defaultdict lookups
+            if prob <= 0.0:
+                bitransitions[tag_ids[prev_state], tag_ids[state]] = prob
+
+    word_rows = np.array([word_ids[word] for word in vocab], dtype=np.intp)
+    word_rows = word_rows[np.frombuffer(emission_words, dtype=np.int32)]
+    state_columns = np.array([tag_ids[state] for state in emission_tags], dtype=np.intp)
+    scores = np.array(emission_probs, dtype=np.float64)
+
+    # Signature rows of the suffix model follow the words
+    signature_list = []
+    if suffix_signatures:
+        oov = word_rows == word_ids[OOV_WORD]
+        (signature_list, signature_rows, signature_columns, signature_scores) = suffix_emissions(
+            suffix_signatures, np.array([tag_ids[state] for state in suffix_tags], dtype=np.intp),
+            np.frombuffer(suffix_probs, dtype=np.float64), suffix_theta,
+            state_columns[oov], scores[oov], len(tag_list))
+        word_rows = np.concatenate([word_rows, signature_rows + len(word_list)])
+        state_columns = np.concatenate([state_columns, signature_columns])
+        scores = np.concatenate([scores, signature_scores])
+    emissions = sparse_emissions(word_rows, state_columns, scores, len(word_list) + len(signature_list))
+
+    unigrams = np.full(len(tag_list), -np.inf)
+    for (state, prob) in uniform.items():
+        unigrams[tag_ids[state]] = prob
+
+    # Trigrams are sparse, so keep them as a list of entries
+    entries = [((tag_ids[prev_prev_state], tag_ids[prev_state], tag_ids[state]), prob)
+        for (prev_prev_state, middle) in tritransition.items()
+        for (prev_state, row) in middle.items()
+        for (state, prob) in row.items() if prob <= 0.0]
+
+    install_model(tag_list, word_list, (norm_a, norm_b, norm_c), dict(emissions,
+        log_bitransition=bitransitions,
+        log_unigram=unigrams,
+        tritransition_index=np.array([e[0] for e in entries], dtype=np.int32).reshape(-1, 3),
+        log_tritransition=np.array([e[1] for e in entries], dtype=np.float64),
+    ), signature_list, suffix_length)
+
+    # The entries now live in the sparse table
+    del emission_words[:], emission_tags[:], emission_probs[:]
+    del suffix_signatures[:], suffix_tags[:], suffix_probs[:]
+
+# Build the sparse emission arrays from (word index, state index, log
+#   probability) entries in any order, dropping impossible ones
+# Used for text models, for compiled files from before the sparse table,
+#   and by tools that estimate models in memory
+def sparse_emissions(word_rows, state_columns, scores, num_words):
+    keep = np.isfinite(scores)
+    (word_rows, state_columns, scores) = (word_rows[keep], state_columns[keep], scores[keep])
+    order = np.lexsort((state_columns, word_rows))
+    return {
+        "emission_offsets": np.searchsorted(word_rows[order], np.arange(num_words + 1)).astype(np.int64),
+        "emission_states": state_columns[order].astype(np.int32),
+        "emission_scores": scores[order].astype(np.float64),
+    }
+
+# Emission entries of the signature rows of a suffix model, given its
+#   (signature, state index, P(state | signature)) entries, its theta and
+#   the OOV row's states and log probabilities
+# Each signature's distribution is interpolated with that of the signature
+#   one step less specific, shape:suffix with shape:uffix and a shape with
+#   all rare words, as (P(state | signature) + theta * parent) / (1 + theta),
+#   so long suffixes seen on few words lean on shorter ones
+# The result rescales the OOV emission by how much likelier the signature
+#   makes each state than rare words in general:
+#   log P(word | state) = log P(OOV | state) + log P~(state | signature)
+#                         - log P(state | all rare words)
+# Returns the signatures in row order and the row, state index and log
+#   probability of each entry
+def suffix_emissions(entry_signatures, entry_states, entry_probs, theta, oov_states, oov_scores, num_states):
+    signature_list = sorted(set(entry_signatures) - {word_shapes.ALL_RARE})
+    ids = {word_shapes.ALL_RARE: 0}
+    ids.update((signature, i + 1) for (i, signature) in enumerate(signature_list))
+    probs = np.zeros((len(ids), num_states))
+    probs[[ids[signature] for signature in entry_signatures], entry_states] = entry_probs
+
+    # The parent of each signature, and its depth below all rare words
+    parents = np.zeros(len(ids), dtype=np.intp)
+    depths = np.zeros(len(ids), dtype=np.intp)
+    for signature in signature_list:
+        (shape, colon, suffix) = signature.partition(":")
+        parent = word_shapes.ALL_RARE if not colon else shape if len(suffix) == 1 else shape + ":" + suffix[1:]
+        parents[ids[signature]] = ids.get(parent, 0)
+        depths[ids[signature]] = 1 + len(suffix)
+
+    smoothed = probs.copy()
+    for depth in range(1, depths.max() + 1):
+        rows = np.flatnonzero(depths == depth)
+        smoothed[rows] = (probs[rows] + theta * smoothed[parents[rows]]) / (1 + theta)
+
+    base = probs[0, oov_states]
+    with np.errstate(divide="ignore"):
+        correction = np.where(base > 0, np.log(smoothed[1:, oov_states]) - np.log(np.where(base > 0, base, 1)), 0.0)
+    return (signature_list, np.repeat(np.arange(len(signature_list)), len(oov_states)),
+        np.tile(oov_states, len(signature_list)), (oov_scores + correction).ravel())
+
+# Make the given tables the current model
+# tag_list and word_list give the states and words in index order, and
+#   arrays holds the compiled tables by name; the trigram tensor is derived
+#   from them and the caches are emptied
+# signature_list names the suffix model's rows after the words, and
+#   suffix_max is the longest suffix its signatures use
+# Used by both loaders, and by tools that estimate models in memory
+def install_model(tag_list, word_list, norms, arrays, signature_list=(), suffix_max=0):
+    global oov_index, init_index, final_index, log_bitransition, log_unigram
+    global emission_offsets, emission_states, emission_scores
+    global tritransition_index, log_tritransition
+    global norm_a, norm_b, norm_c, max_suffix
+
+    tags[:] = tag_list
+    tag_index.clear()
+    tag_index.update((state, i) for (i, state) in enumerate(tags))
+    init_index = tag_index[INIT_STATE]
+    final_index = tag_index[FINAL_STATE]
+    words[:] = word_list
+    word_index.clear()
+    word_index.update((word, i) for (i, word) in enumerate(words))
+    oov_index = word_index[OOV_WORD]
+    signatures[:] = signature_list
+    signature_index.clear()
+    signature_index.update((signature, len(words) + i) for (i, signature) in enumerate(signatures))
+    max_suffix = suffix_max
+    (norm_a, norm_b, norm_c) = norms
+
+    log_bitransition = arrays["log_bitransition"]
+    emission_offsets = arrays["emission_offsets"]
+    emission_states = arrays["emission_states"]
+    emission_scores = arrays["emission_scores"]
+    log_unigram = arrays["log_unigram"]
+    tritransition_index = arrays["tritransition_index"]
+    log_tritransition = arrays["log_tritransition"]
+
+    compile_trigram()
+    word_emissions.cache_clear()
+    unknown_word_row.cache_clear()
+    sentence_cache.clear()
+
+# Write the compiled tables to a single binary file:
+#   magic, 8-byte header length, JSON header, then each array's raw bytes
+#   at an aligned offset recorded in the header
+def save_compiled_model(path):
+    arrays = {
+        "log_bitransition": log_bitransition,
+        "emission_offsets": emission_offsets,
+        "emission_states": emission_states,
+        "emission_scores": emission_scores,
+        "log_unigram": log_unigram,
+        "tritransition_index": tritransition_index,
+        "log_tritransition": log_tritransition,
+    }
+    header = {
+        "tags": tags,
+        "words": words,
+        "norms": [norm_a, norm_b, norm_c],
+        "signatures": signatures,
+        "max_suffix": max_suffix,
+        "arrays": {},
+    }
+
+    # Offsets are relative to the end of the header so they can be
+    #   computed before the header length is known
+    offset = 0
+    for (name, values) in arrays.items():
+        header["arrays"][name] = {
+            "dtype": values.dtype.str, "shape": values.shape, "offset": offset}
+        offset += -(-values.nbytes // COMPILED_ALIGNMENT) * COMPILED_ALIGNMENT
 
-        try:
-            v = V[len(words) - 1][state] + bitransition_prob
-        except KeyError as e:
+    encoded = json.dumps(header).encode("utf-8")
+    start = len(COMPILED_MAGIC) + 8 + len(encoded)
+    start += -start % COMPILED_ALIGNMENT
+    with open(path, "wb") as f:
+        f.write(COMPILED_MAGIC)
+        f.write(len(encoded).to_bytes(8, "little"))
+        f.write(encoded)
+        for (name, values) in arrays.items():
+            f.seek(start + header["arrays"][name]["offset"])
+            f.write(np.ascontiguousarray(values).tobytes())
+
+# Memory-map a file written by save_compiled_model
+# The arrays are read-only views into the mapping, so worker processes
+#   decoding with the same compiled file share its pages
+def load_compiled_model(path):
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header_start = len(COMPILED_MAGIC) + 8
+    header_length = int.from_bytes(mapped[len(COMPILED_MAGIC):header_start], "little")
+    header = json.loads(mapped[header_start:header_start + header_length])
+    start = header_start + header_length
+    start += -start % COMPILED_ALIGNMENT
+
+    arrays = {}
+    for (name, spec) in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"]))
+        if count == 0:
+            arrays[name] = np.empty(spec["shape"], dtype=dtype)
             continue
+        arrays[name] = np.frombuffer(mapped, dtype=dtype, count=count,
+            offset=start + spec["offset"]).reshape(spec["shape"])
+
+    # Older files hold a dense [word, state] emission table
+    if "log_emission" in arrays:
+        dense = arrays.pop("log_emission")
+        (word_rows, state_columns) = np.nonzero(np.isfinite(dense))
+        arrays.update(sparse_emissions(word_rows, state_columns, dense[word_rows, state_columns], len(dense)))
+
+    install_model(header["tags"], header["words"], header["norms"], arrays,
+        header.get("signatures", []), header.get("max_suffix", 0))
 
-        # Replace if probability is higher
-        current = V[len(words)].get(FINAL_STATE, None)
-        if not current or v > V[len(words)][FINAL_STATE]:
-            V[len(words)][FINAL_STATE] = v
-            best_final_state = state
+# Score below which hypotheses fall outside a beam of the given width
+# Ties at the threshold are all kept
+def beam_threshold(V, beam):
+    if beam is None or V.size <= beam:
+        return -np.inf
+    return np.partition(V, -beam, axis=None)[-beam]
 
-    return (best_final_state, back)
+# Row of the emission table for a word: its own row if it is in the
+#   vocabulary, else the row of its most specific signature in the suffix
+#   model, else the OOV row
+def word_row(word):
+    row = word_index.get(word)
+    if row is None:
+        row = unknown_word_row(word)
+    return row
 
-# includes trigram and deleted interpolation
-def trigram_viterbi(index, line):
-    words = line.split()
+# Look an unknown word's signatures up from the most specific down
+# Cached per word string, since unknown words recur; the cache is cleared
+#   whenever a model is loaded
+@functools.lru_cache(maxsize=WORD_CACHE_SIZE)
+def unknown_word_row(word):
+    if signature_index:
+        for signature in reversed(word_shapes.word_signatures(word, max_suffix)):
+            row = signature_index.get(signature)
+            if row is not None:
+                return row
+    return oov_index
 
-    # Setup Viterbi for this sentence:
-    # V[x][y] where x is the index of the word in the line
-    #   and y is a state pair in the set of state pairs
-    V = defaultdict(lambda: {})
+# Candidate states of a row of the emission table and their emission log
+#   probabilities; both are views into the sparse table
+# Cached per row so frequent words skip the slicing; the cache is cleared
+#   whenever a model is loaded
+@functools.lru_cache(maxsize=WORD_CACHE_SIZE)
+def word_emissions(row):
+    (start, end) = emission_offsets[row:row + 2]
+    return (emission_states[start:end], emission_scores[start:end])
+
+# Bigram viterbi algorithm over the dense transition table and the sparse
+#   emission rows of the words
+# With a beam width only the beam best states survive each word, which
+#   trades exactness for speed on large tagsets
+# The line is given as its rows of the emission table, as from line_indices
+# Returns the index of the best state before the final state (or None if no
+#   path reaches the final state) and the backpointer array
+def bigram_viterbi(index, rows, beam=None):
+    words = [word_emissions(row) for row in rows]
 
-    # Initialize backtrace so we get recover the path:
     # back[x][y] where x is the index of the word in the line
-    #   and y is the previous state pair with the highest probability
-    back = defaultdict(lambda: defaultdict(lambda: ""))
+    #   and y is a state index, holds the best previous state index
+    # Only the entries for the candidates of word x are filled in
+    back = np.zeros((len(words), len(tags)), dtype=np.intp)
 
-    # Initialize V with init state pair
-    # REDUNDANT
-    V[-1] = defaultdict(lambda: 0.0)
-    V[-1][(INIT_STATE, INIT_STATE)] = 1.0
+    # V[y] is the highest log probability of any path ending in the
+    #   candidate y of the current word; before the first word only init
+    #   is possible
+    prev_candidates = np.array([init_index])
+    V = np.zeros(1)
 
     # Iterate over each word in the line
-    for i in range(len(words)):
+    for (i, (current, emission_scores)) in enumerate(words):
+        # A word without candidates leaves no path through the line
+        if len(current) == 0:
+            return (None, back)
 
-        # If word not in vocab, replace with OOV word
-        if words[i] not in vocab:
-            words[i] = OOV_WORD
+        # scores[x][y] is the log probability of the best path through
+        #   candidate prev_state x followed by the transition x -> y
+        scores = V[:, np.newaxis] + log_bitransition[prev_candidates[:, np.newaxis], current]
+        back[i, current] = prev_candidates[scores.argmax(axis=0)]
+        V = scores.max(axis=0) + emission_scores
+        prev_candidates = current
+        if instrumented:
+            instrument_stats["count.transitions_evaluated"] += scores.size
+            instrument_stats["count.transitions_skipped"] += len(tags) ** 2 - scores.size
 
-        # Iterate over all possible current states:
-        for state in states:
+        # Prune to the beam
+        threshold = beam_threshold(V, beam)
+        if threshold > -np.inf:
+            keep = np.flatnonzero(V >= threshold)
+            if instrumented:
+                instrument_stats["count.beam_pruned"] += len(V) - len(keep)
+            (prev_candidates, V) = (prev_candidates[keep], V[keep])
 
-            # If this emission is impossible for this state, move on
-            emission_prob = emission[state][words[i]]
-            if emission_prob > 0.0 or emission_prob == 1.0:
-                continue
+    # Handle final state
+    scores = V + log_bitransition[prev_candidates, final_index]
+    if len(scores) == 0 or scores.max() == -np.inf:
+        return (None, back)
 
-            # Iterate over all possible previous states:
-            # Specifically, prev_state -> state
-            for (prev_prev_state, prev_state) in state_pairs:
-
-                # If this emission is impossible for the prev state, move on
-                if i>0:
-                    prev_emission_prob = emission[prev_state][words[i-1]]
-                    if prev_emission_prob > 0.0 or prev_emission_prob == 1.0:
-                        continue
-                # If this emission is impossible for the prev prev state, move on
-                if i>1:
-                    emission_prob = emission[state][words[i-2]]
-                    if emission_prob > 0.0 or emission_prob == 1.0:
-                        continue
-                # If this transition is impossible for this state, move on
-                tritransition_prob = math.exp(tritransition[prev_prev_state][prev_state][state])
-                bitransition_prob = math.exp(bitransition[prev_state][state])
-                uniform_prob = math.exp(uniform[state])
-                # interpolated_prob = math.log(norm_a*uniform_prob + norm_b*bitransition_prob + norm_c*tritransition_prob)
-                interpolated_prob = math.log(tritransition_prob)
-                if interpolated_prob > 0.0 or interpolated_prob == 1.0:
-                    continue
-
-                # Calculate the (log) probability of:
-                # 1. The highest probability of the previous state being pre_state
-                # 2. The probability of transition prev_state -> state
-                # 3. The probability of emission state -> words[i]
-                try:
-                    v = V[i - 1][(prev_prev_state, prev_state)] + interpolated_prob + emission_prob
-                except KeyError as e:
-                    continue
-
-                # Replace if probability is higher
-                current = V[i].get((prev_state, state), None)
-                if not current or v > V[i][(prev_state, state)]:
-                    V[i][(prev_state, state)] = v
-                    back[i][state] = prev_state
-
-    # Handle final state    
-    best_final_state = None
-    for (prev_state, state) in state_pairs:
-        tritransition_prob = math.exp(tritransition[prev_state][state][FINAL_STATE])
-        bitransition_prob = math.exp(bitransition[state][FINAL_STATE])
-        uniform_prob = 0
-        # interpolated_prob = math.log(norm_a*uniform_prob + norm_b*bitransition_prob + norm_c*tritransition_prob)
-        interpolated_prob = math.log(tritransition_prob)
-        if interpolated_prob >= 0:
-            continue
+    return (int(prev_candidates[scores.argmax()]), back)
+
+# Recover the tag sequence from a best final state and backpointer array
+def backtrace(best_final_state, back):
+    output = []
+    state = best_final_state
+    # Step from len(back) to 0
+    for i in range(len(back) - 1, -1, -1):
+        output.append(tags[state])
+        state = back[i][state]
+
+    # Reverse the output and join as string
+    return " ".join(output[::-1])
+
+# Build the deleted-interpolation transition tensor for trigram_viterbi:
+#   q(w | u, v) = norm_a * P(w) + norm_b * P(w | v) + norm_c * P(w | u, v)
+#   with unseen unigrams, bigrams and trigrams contributing zero
+# Stored in log space so the recursion only ever adds
+# A model without a norms line falls back to the bigram probabilities
+def compile_trigram():
+    global log_interpolation
+
+    weights = (norm_a, norm_b, norm_c)
+    if None in weights:
+        weights = (0.0, 1.0, 0.0)
+
+    trigram = np.zeros((len(tags), len(tags), len(tags)))
+    (u, v, w) = tritransition_index.T
+    trigram[u, v, w] = np.exp(log_tritransition)
+
+    interpolation = weights[2] * trigram
+    interpolation += weights[1] * np.exp(log_bitransition)[np.newaxis, :, :]
+    interpolation += weights[0] * np.exp(log_unigram)[np.newaxis, np.newaxis, :]
+    with np.errstate(divide="ignore"):
+        log_interpolation = np.log(interpolation)
+
+# Trigram viterbi algorithm with deleted interpolation
+# The recursion runs over state pairs: V[u][v] is the highest log probability
+#   of any path whose last two states are u then v
+# With a beam width only the beam best pairs survive each word; the rows
+#   and columns of V left without a surviving pair are dropped
+# Returns the best (prev_state, state) pair before the final state (or None
+#   if no path reaches the final state) and the backpointer array
+def trigram_viterbi(index, rows, beam=None):
+    words = [word_emissions(row) for row in rows]
+
+    # back[x][v][w] where x is the index of the word in the line and the
+    #   pair v, w are the states at x - 1 and x, holds the best state at x - 2
+    # Only the entries for candidate pairs of words x - 1 and x are filled in
+    back = np.zeros((len(words), len(tags), len(tags)), dtype=np.intp)
+
+    # Before the first word the path is init, init
+    # V is indexed by positions in the candidate arrays of the previous two
+    #   words rather than by state
+    prev_prev_candidates = prev_candidates = np.array([init_index])
+    V = np.zeros((1, 1))
+
+    # Iterate over each word in the line
+    for (i, (current, emission_scores)) in enumerate(words):
+        # A word without candidates leaves no path through the line
+        if len(current) == 0:
+            return (None, back)
+
+        # scores[u][v][w] is the log probability of the best path through
+        #   the pair u, v followed by the transition u, v -> w
+        scores = V[:, :, np.newaxis] + log_interpolation[
+            prev_prev_candidates[:, np.newaxis, np.newaxis],
+            prev_candidates[:, np.newaxis], current]
+        back[i, prev_candidates[:, np.newaxis], current] = prev_prev_candidates[scores.argmax(axis=0)]
+        V = scores.max(axis=0) + emission_scores
+        (prev_prev_candidates, prev_candidates) = (prev_candidates, current)
+        if instrumented:
+            instrument_stats["count.transitions_evaluated"] += scores.size
+            instrument_stats["count.transitions_skipped"] += len(tags) ** 3 - scores.size
+
+        # Prune to the beam
+        threshold = beam_threshold(V, beam)
+        if threshold > -np.inf:
+            if instrumented:
+                instrument_stats["count.beam_pruned"] += int(np.count_nonzero(V < threshold))
+            V = np.where(V >= threshold, V, -np.inf)
+            live_rows = np.flatnonzero((V > -np.inf).any(axis=1))
+            live_columns = np.flatnonzero((V > -np.inf).any(axis=0))
+            V = V[live_rows[:, np.newaxis], live_columns]
+            (prev_prev_candidates, prev_candidates) = (prev_prev_candidates[live_rows], prev_candidates[live_columns])
+
+    # Handle final state
+    scores = V + log_interpolation[
+        prev_prev_candidates[:, np.newaxis], prev_candidates, final_index]
+    if scores.size == 0 or scores.max() == -np.inf:
+        return (None, back)
+
+    (prev_state, state) = np.unravel_index(scores.argmax(), scores.shape)
+    return ((int(prev_prev_candidates[prev_state]), int(prev_candidates[state])), back)
+
+# Recover the tag sequence from a best final state pair and the pair
+#   backpointer array
+def trigram_backtrace(best_final_pair, back):
+    output = []
+    (prev_state, state) = best_final_pair
+    # Step from len(back) to 0
+    for i in range(len(back) - 1, -1, -1):
+        output.append(tags[state])
+        (prev_state, state) = (back[i][prev_state][state], prev_state)
+
+    # Reverse the output and join as string
+    return " ".join(output[::-1])
+
+
+# N-best bigram viterbi algorithm
+# Like bigram_viterbi, but V[x][r] is the log probability of the r-th best
+#   path ending in candidate x of the current word, for r < n; at each word
+#   the n best of all (previous candidate, rank) extensions are kept per
+#   candidate with one argsort over a small (candidates x n) block
+# Ties are broken towards the smaller previous candidate, so with n = 1 the
+#   path is the one bigram_viterbi finds
+# Returns up to n (log probability, tag line) pairs, best first, for the
+#   paths that reach the final state
+def bigram_nbest(rows, n):
+    words = [word_emissions(row) for row in rows]
+
+    # A word without candidates leaves no path through the line
+    if any(len(current) == 0 for (current, emission_scores) in words):
+        return []
+
+    # back[x] holds, for rank r and candidate y of word x, the flat index
+    #   x' * width + r' of the path it extends, where width is the number of
+    #   ranks kept at word x - 1
+    back = []
+    widths = []
+    prev_candidates = np.array([init_index])
+    V = np.zeros((1, 1))
+    for (current, emission_scores) in words:
+        scores = (V[:, :, np.newaxis] + log_bitransition[
+            prev_candidates[:, np.newaxis, np.newaxis], current]).reshape(-1, len(current))
+        order = (-scores).argsort(axis=0, kind="stable")[:n]
+        back.append(order)
+        widths.append(V.shape[1])
+        V = scores[order, np.arange(len(current))].T + emission_scores[:, np.newaxis]
+        prev_candidates = current
+
+    # Handle final state
+    final_scores = (V + log_bitransition[prev_candidates, final_index][:, np.newaxis]).ravel()
+    best = np.argsort(-final_scores, kind="stable")[:n]
+    best = best[final_scores[best] > -np.inf]
+
+    # Backtrace all the paths together
+    (positions, ranks) = np.divmod(best, V.shape[1])
+    output = []
+    for i in range(len(words) - 1, -1, -1):
+        output.append(words[i][0][positions])
+        (positions, ranks) = np.divmod(back[i][ranks, positions], widths[i])
+    return nbest_paths(final_scores[best], output)
+
+# N-best trigram viterbi algorithm with deleted interpolation
+# Like trigram_viterbi, with V[u][v][r] the log probability of the r-th best
+#   path whose last two states are the candidates u then v, and the n best
+#   (u, rank) extensions kept for each new pair
+# Returns up to n (log probability, tag line) pairs, best first
+def trigram_nbest(rows, n):
+    words = [word_emissions(row) for row in rows]
+
+    # A word without candidates leaves no path through the line
+    if any(len(current) == 0 for (current, emission_scores) in words):
+        return []
+
+    # back[x][r][v][w] is the flat index u * width + r' of the path that the
+    #   r-th best path through the pair v, w at words x - 1, x extends
+    back = []
+    widths = []
+    prev_prev_candidates = prev_candidates = np.array([init_index])
+    V = np.zeros((1, 1, 1))
+    for (current, emission_scores) in words:
+        scores = V[:, :, :, np.newaxis] + log_interpolation[
+            prev_prev_candidates[:, np.newaxis, np.newaxis, np.newaxis],
+            prev_candidates[:, np.newaxis, np.newaxis], current]
+        scores = scores.transpose(0, 2, 1, 3).reshape(-1, len(prev_candidates), len(current))
+        order = (-scores).argsort(axis=0, kind="stable")[:n]
+        back.append(order)
+        widths.append(V.shape[2])
+        V = scores[order, np.arange(len(prev_candidates))[:, np.newaxis], np.arange(len(current))]
+        V = V.transpose(1, 2, 0) + emission_scores[:, np.newaxis]
+        (prev_prev_candidates, prev_candidates) = (prev_candidates, current)
+
+    # Handle final state
+    final_scores = (V + log_interpolation[
+        prev_prev_candidates[:, np.newaxis], prev_candidates, final_index][:, :, np.newaxis]).ravel()
+    best = np.argsort(-final_scores, kind="stable")[:n]
+    best = best[final_scores[best] > -np.inf]
+
+    # Backtrace all the paths together, tracking the positions of the last
+    #   two candidates and the rank
+    (prev_positions, positions, ranks) = np.unravel_index(best, V.shape)
+    output = []
+    for i in range(len(words) - 1, -1, -1):
+        output.append(words[i][0][positions])
+        (prev_prev_positions, ranks) = np.divmod(back[i][ranks, prev_positions, positions], widths[i])
+        (prev_positions, positions) = (prev_prev_positions, prev_positions)
+    return nbest_paths(final_scores[best], output)
+
+# Pair the scores of n-best paths with their tag lines, given the state
+#   indices of all paths at each word from the last word to the first
+def nbest_paths(scores, output):
+    if not output:
+        return [(float(score), "") for score in scores]
+    sequences = np.stack(output[::-1], axis=1)
+    return [(float(score), " ".join(tags[state] for state in sequence))
+        for (score, sequence) in zip(scores, sequences.tolist())]
 
-        try:
-            v = V[len(words) - 1][(prev_state, state)] + interpolated_prob
-        except KeyError as e:
-            continue
 
-        # Replace if probability is higher
-        current = V[len(words)].get((state, FINAL_STATE), None)
-        if not current or v > V[len(words)][(state, FINAL_STATE)]:
-            V[len(words)][(state, FINAL_STATE)] = v
-            best_final_state = state
-    return (best_final_state, back)
+# Emission table rows of a line's words, as a tuple to key the sentence
+#   cache by and for the decoders
+# A line is either text, whose words are looked up by word_row, or an array
+#   of rows as read from a corpus cache by corpus_sentences
+def line_indices(line):
+    if isinstance(line, str):
+        return tuple(word_row(word) for word in line.split())
+    return tuple(line.tolist())
 
+# Sentences of a corpus cache file as arrays of emission table rows of the
+#   current model; each type in the cache is looked up once
+def corpus_sentences(path):
+    corpus = corpus_cache.load_corpus(path)
+    id_map = np.array([word_row(word) for word in corpus.vocab], dtype=np.intp)
+    return corpus_cache.sentence_ids(corpus, id_map)
 
 # Actual Viterbi function that takes a list of lines of text as input
 # The original version (and most versions) take in a single line of text.
@@ -232,63 +794,396 @@ def trigram_viterbi(index, line):
 #   resource sharing
 # NOTE: the state and vocab sets are still shared but it does not seem
 #       to impact performance by much
-def viterbi(lines):
+# A beam width switches both decoders to beam search
+def viterbi(lines, trigram=False, beam=None):
     ret = [""] * len(lines)
+    words_before = word_emissions.cache_info()
     for (index, line) in enumerate(lines):
-        (bi_best_final_state, bi_back) = bigram_viterbi(index, line)
-        bi_sequence = None
-        # Backtrace from the best_final_state
-        if bi_best_final_state:
-            words = line.split()
-            output = []
-            # Step from len(words) to 0
-            for i in range(len(words) - 1, -1, -1):
-                output.append(bi_best_final_state)
-                bi_best_final_state = bi_back[i][bi_best_final_state]
-
-            # Reverse the output and join as string
-            bi_sequence = " ".join(output[::-1])
-        # If no best_final_state e.g. could not find transition to terminate
-        # then return empty string
-        else:
-            bi_sequence = ""
-
-        # (tri_best_final_state, tri_back) = trigram_viterbi(index, line)
-        # tri_sequence = None
-        # # Backtrace from the best_final_state
-        # if tri_best_final_state:
-        #     words = line.split()
-        #     output = []
-        #     # Step from len(words) to 0
-        #     for i in range(len(words) - 1, -1, -1):
-        #         output.append(tri_best_final_state)
-        #         tri_best_final_state = tri_back[i][tri_best_final_state]
-
-        #     # Reverse the output and join as string
-        #     tri_sequence = " ".join(output[::-1])
-        # If no best_final_state e.g. could not find transition to terminate
-        # then return empty string
-        # else:
-        #     tri_sequence = ""
-        # if tri_best_final_state:
-        #     ret[index] = tri_sequence
-        # else:
-        #     ret[index] = bi_sequence
-        ret[index] = bi_sequence
+        key = (trigram, beam, line_indices(line))
+        if instrumented:
+            count_tokens(key[2])
+        if key in sentence_cache:
+            sentence_cache.move_to_end(key)
+            ret[index] = sentence_cache[key]
+            cache_stats["sentence_hits"] += 1
+            continue
+        cache_stats["sentence_misses"] += 1
+
+        t0 = time.perf_counter()
+        ret[index] = decode_sentence(index, key[2], trigram, beam)
+        if instrumented:
+            record_latency(time.perf_counter() - t0)
+        if sentence_cache_size > 0:
+            sentence_cache[key] = ret[index]
+            if len(sentence_cache) > sentence_cache_size:
+                sentence_cache.popitem(last=False)
+
+    words_after = word_emissions.cache_info()
+    cache_stats["word_hits"] += words_after.hits - words_before.hits
+    cache_stats["word_misses"] += words_after.misses - words_before.misses
     # Return a list of processed lines
     return ret
 
+# N-best counterpart of viterbi(): the n best (log probability, tag line)
+#   pairs of each line, best first
+# As in decode_sentence, a line the trigram decoder cannot tag is decoded
+#   with the bigram decoder, and a line with no path gets an empty list
+# Results share the sentence cache, under keys of their own
+def nbest_viterbi(lines, n, trigram=False):
+    ret = [None] * len(lines)
+    for (index, line) in enumerate(lines):
+        key = ("nbest", n, trigram, line_indices(line))
+        if instrumented:
+            count_tokens(key[3])
+        if key in sentence_cache:
+            sentence_cache.move_to_end(key)
+            ret[index] = sentence_cache[key]
+            cache_stats["sentence_hits"] += 1
+            continue
+        cache_stats["sentence_misses"] += 1
 
+        t0 = time.perf_counter()
+        with phase("recursion"):
+            paths = trigram_nbest(key[3], n) if trigram else []
+            if not paths:
+                paths = bigram_nbest(key[3], n)
+        ret[index] = paths
+        if instrumented:
+            record_latency(time.perf_counter() - t0)
+        if sentence_cache_size > 0:
+            sentence_cache[key] = paths
+            if len(sentence_cache) > sentence_cache_size:
+                sentence_cache.popitem(last=False)
+    return ret
 
+# Format the n-best paths of one line as one JSON line, a list of
+#   {"score", "tags"} objects, or as TSV, one "score<TAB>tags" line per path
+#   followed by a blank line
+def format_nbest(paths, nbest_format):
+    if nbest_format == "jsonl":
+        return json.dumps([{"score": score, "tags": sequence} for (score, sequence) in paths])
+    return "".join("{}\t{}\n".format(score, sequence) for (score, sequence) in paths)
 
-# Main method
-def main():
+# Decode many lines at once, like viterbi(lines) but with the recursion
+#   run for a whole batch of sentences per array operation
+# Lines already in the sentence cache are answered from it and repeated
+#   lines are decoded once; the rest are sorted by length and cut into
+#   buckets of batch_size sentences of similar length, so little work is
+#   spent on padding
+# Beam search is per sentence, so a beam width falls back to viterbi()
+def batch_viterbi(lines, trigram=False, beam=None, batch_size=BATCH_SIZE):
+    if beam is not None:
+        return viterbi(lines, trigram, beam)
 
-    # Mark start time
-    t0 = time.time()
+    ret = [""] * len(lines)
+    pending = collections.defaultdict(list)
+    for (index, line) in enumerate(lines):
+        key = (trigram, beam, line_indices(line))
+        if instrumented:
+            count_tokens(key[2])
+        if key in sentence_cache:
+            sentence_cache.move_to_end(key)
+            ret[index] = sentence_cache[key]
+            cache_stats["sentence_hits"] += 1
+        else:
+            pending[key].append(index)
+    cache_stats["sentence_misses"] += sum(len(indices) for indices in pending.values())
+
+    keys = [key for key in pending if key[2]]
+    with phase("recursion"):
+        sequences = decode_batches([key[2] for key in keys], trigram, batch_size)
+    for (key, sequence) in zip(keys, sequences):
+        for index in pending[key]:
+            ret[index] = sequence
+
+    if sentence_cache_size > 0:
+        for key in pending:
+            sentence_cache[key] = ret[pending[key][0]]
+            if len(sentence_cache) > sentence_cache_size:
+                sentence_cache.popitem(last=False)
+    return ret
+
+# Decode non-empty sentences of word indices in length-sorted buckets,
+#   returning their tag lines in the given order
+# Each bucket is packed into a padded (sentences x words) array of word
+#   indices, with the true lengths as the mask
+# As in decode_sentence, sentences the trigram decoder cannot tag are
+#   retried with the bigram decoder, and "" is returned for any left over
+def decode_batches(sentences, trigram, batch_size):
+    ret = [""] * len(sentences)
+    lengths = np.array([len(sentence) for sentence in sentences], dtype=np.intp)
+    order = np.argsort(lengths, kind="stable")
+    failed = []
+    for start in range(0, len(order), batch_size):
+        t0 = time.perf_counter()
+        bucket = order[start:start + batch_size]
+        ids = np.full((len(bucket), lengths[bucket[-1]]), oov_index, dtype=np.intp)
+        for (row, sentence) in enumerate(bucket):
+            ids[row, :lengths[sentence]] = sentences[sentence]
+
+        # A word without candidates leaves no path through its sentence
+        mask = np.arange(ids.shape[1]) < lengths[bucket, np.newaxis]
+        taggable = ((np.diff(emission_offsets)[ids] > 0) | ~mask).all(axis=1)
+        if not taggable.all():
+            failed.extend(bucket[~taggable])
+            (bucket, ids) = (bucket[taggable], ids[taggable])
+            if len(bucket) == 0:
+                continue
+
+        decoder = trigram_viterbi_batch if trigram else bigram_viterbi_batch
+        for (row, sequence) in enumerate(decoder(ids, lengths[bucket])):
+            if sequence is None:
+                failed.append(bucket[row])
+            else:
+                ret[bucket[row]] = " ".join(tags[state] for state in sequence)
+        if instrumented:
+            record_latency((time.perf_counter() - t0) / len(bucket), len(bucket))
+
+    if trigram and failed:
+        retried = decode_batches([sentences[i] for i in failed], False, batch_size)
+        for (i, sequence) in zip(failed, retried):
+            ret[i] = sequence
+    return ret
+
+# Split arange(sum(counts)) into consecutive runs of the given lengths
+# Returns the run of each element, its position within the run, and the
+#   start of each run
+def ragged_arange(counts):
+    starts = np.cumsum(counts) - counts
+    owner = np.repeat(np.arange(len(counts)), counts)
+    return (owner, np.arange(len(owner)) - starts[owner], starts)
+
+# Max of each consecutive run of scores and, for ties, the smallest of
+#   sources among the elements reaching it, which matches argmax over
+#   candidates in ascending state order
+def run_argmax(scores, sources, owner, starts):
+    best = np.maximum.reduceat(scores, starts)
+    first = np.minimum.reduceat(np.where(scores == best[owner], sources, np.iinfo(np.intp).max), starts)
+    return (best, first)
+
+# Bigram viterbi algorithm over a bucket of sentences
+# ids is the padded (sentences x words) array of word indices and lengths
+#   the true length of each row, in ascending order
+# The recursion is the same as bigram_viterbi's, run over the candidates of
+#   every row at once: the candidates of all rows at a word are laid out
+#   in one flat array, each row in its own run, and every (previous
+#   candidate, candidate) pair within a row is an edge, so rows with few
+#   candidates do no padded work for rows with many
+# A row is dropped once its last word has been scored against the final
+#   state, so padding words are never decoded
+# Returns the state index sequence of each row, or None where no path
+#   reaches the final state
+def bigram_viterbi_batch(ids, lengths):
+    results = [None] * len(ids)
+
+    # step_states[x] holds the flat candidate states at word x, and back[x]
+    #   the position of the best previous candidate in step_states[x - 1]
+    step_states = []
+    back = []
+
+    # Before the first word every row's only candidate is init
+    # prev_offsets and prev_counts give each active row's run of candidates
+    prev_states = np.full(len(ids), init_index)
+    prev_offsets = np.arange(len(ids))
+    prev_counts = np.ones(len(ids), dtype=np.intp)
+    V = np.zeros(len(ids))
+    done = 0
+    for i in range(ids.shape[1]):
+        word_rows = ids[done:, i]
+        counts = np.diff(emission_offsets)[word_rows]
+        (row, k, offsets) = ragged_arange(counts)
+        entries = emission_offsets[word_rows[row]] + k
+        states = emission_states[entries]
+
+        # scores[e] is the log probability of the best path through the
+        #   previous candidate of edge e followed by its transition
+        (edge, x, edge_starts) = ragged_arange(prev_counts[row])
+        sources = prev_offsets[row[edge]] + x
+        scores = V[sources] + log_bitransition[prev_states[sources], states[edge]]
+        (best, best_sources) = run_argmax(scores, sources, edge, edge_starts)
+        if instrumented:
+            instrument_stats["count.transitions_evaluated"] += scores.size
+            instrument_stats["count.transitions_skipped"] += len(word_rows) * len(tags) ** 2 - scores.size
+        V = best + emission_scores[entries]
+        step_states.append(states)
+        back.append(best_sources)
+        (prev_states, prev_offsets, prev_counts) = (states, offsets, counts)
+
+        # Handle the final state for the rows that end at this word
+        ending = np.searchsorted(lengths[done:], i + 1, side="right")
+        if ending:
+            end = offsets[ending - 1] + counts[ending - 1]
+            final_scores = V[:end] + log_bitransition[states[:end], final_index]
+            (best, best_entries) = run_argmax(final_scores, np.arange(end), row[:end], offsets[:ending])
+            with phase("backtrace"):
+                sequences = batch_backtrace(best_entries, step_states, back)
+            for (j, (score, sequence)) in enumerate(zip(best, sequences)):
+                if score > -np.inf:
+                    results[done + j] = sequence
+            (prev_offsets, prev_counts) = (prev_offsets[ending:], prev_counts[ending:])
+            done += ending
+
+    return results
+
+# Recover the state sequences of rows that all end at the same word, from
+#   their best final positions and the per-word backpointers
+def batch_backtrace(positions, step_states, back):
+    output = []
+    # Step from the last word to 0
+    for i in range(len(step_states) - 1, -1, -1):
+        output.append(step_states[i][positions])
+        positions = back[i][positions]
+
+    # Reverse the output and split by row
+    return np.stack(output[::-1], axis=1).tolist()
+
+# Trigram viterbi algorithm over a bucket of sentences
+# The recursion is the same as trigram_viterbi's, run over the candidate
+#   pairs of every row at once: each row's pairs of previous and current
+#   candidates form a run of a flat array, previous-candidate major, and
+#   an edge joins each pair to each pair it can follow
+# Rows are dropped as their sentences end, as in bigram_viterbi_batch
+# Returns the state index sequence of each row, or None where no path
+#   reaches the final state
+def trigram_viterbi_batch(ids, lengths):
+    results = [None] * len(ids)
+
+    # step_states[x] holds the state at word x of each flat pair, and back[x]
+    #   the position of the best pair before it in step_states[x - 1]
+    step_states = []
+    back = []
+
+    # Before the first word every row's only pair is init, init
+    # The runs of the current word's candidates are given by cur_offsets
+    #   and cur_counts, and those of the pairs by pair_offsets; the
+    #   previous word has prev_counts candidates in each row
+    # pair_first holds the state at the previous word of each pair
+    cur_states = pair_first = np.full(len(ids), init_index)
+    cur_offsets = pair_offsets = np.arange(len(ids))
+    cur_counts = prev_counts = np.ones(len(ids), dtype=np.intp)
+    V = np.zeros(len(ids))
+    done = 0
+    for i in range(ids.shape[1]):
+        word_rows = ids[done:, i]
+        counts = np.diff(emission_offsets)[word_rows]
+        (row, k, offsets) = ragged_arange(counts)
+        entries = emission_offsets[word_rows[row]] + k
+        states = emission_states[entries]
+
+        # New pairs v, w of the current and next candidates, and for each
+        #   an edge from every pair u, v
+        (pair_row, j, new_pair_offsets) = ragged_arange(cur_counts * counts)
+        v = cur_offsets[pair_row] + j // counts[pair_row]
+        w = offsets[pair_row] + j % counts[pair_row]
+        (edge, u, edge_starts) = ragged_arange(prev_counts[pair_row])
+        edge_row = pair_row[edge]
+        sources = pair_offsets[edge_row] + u * cur_counts[edge_row] + (v[edge] - cur_offsets[edge_row])
+
+        # scores[e] is the log probability of the best path through the
+        #   pair u, v of edge e followed by the transition u, v -> w
+        scores = V[sources] + log_interpolation[pair_first[sources], cur_states[v[edge]], states[w[edge]]]
+        (best, best_sources) = run_argmax(scores, sources, edge, edge_starts)
+        if instrumented:
+            instrument_stats["count.transitions_evaluated"] += scores.size
+            instrument_stats["count.transitions_skipped"] += len(word_rows) * len(tags) ** 3 - scores.size
+        V = best + emission_scores[entries[w]]
+        pair_first = cur_states[v]
+        step_states.append(states[w])
+        back.append(best_sources)
+        (prev_counts, cur_states, cur_offsets, cur_counts, pair_offsets) = (
+            cur_counts, states, offsets, counts, new_pair_offsets)
+
+        # Handle the final state for the rows that end at this word
+        ending = np.searchsorted(lengths[done:], i + 1, side="right")
+        if ending:
+            end = pair_offsets[ending - 1] + prev_counts[ending - 1] * cur_counts[ending - 1]
+            final_scores = V[:end] + log_interpolation[pair_first[:end], step_states[-1][:end], final_index]
+            (best, best_pairs) = run_argmax(final_scores, np.arange(end), pair_row[:end], pair_offsets[:ending])
+            with phase("backtrace"):
+                sequences = batch_backtrace(best_pairs, step_states, back)
+            for (j, (score, sequence)) in enumerate(zip(best, sequences)):
+                if score > -np.inf:
+                    results[done + j] = sequence
+            (prev_counts, cur_offsets, cur_counts, pair_offsets) = (
+                prev_counts[ending:], cur_offsets[ending:], cur_counts[ending:], pair_offsets[ending:])
+            done += ending
 
-    # Read HMM transition and emission probabilities
-    with open(HMM_FILE, "r") as f:
+    return results
+
+# Pool task: decode a chunk of lines and also return the cache counters and
+#   instrumentation it added, so the main process can report totals over
+#   all workers
+# With nbest each result is the line's n-best list formatted by format_nbest
+def viterbi_chunk(lines, trigram=False, beam=None, batch_size=None, nbest=None, nbest_format="jsonl"):
+    global instrument_sent
+
+    before = collections.Counter(cache_stats)
+    if nbest:
+        results = [format_nbest(paths, nbest_format) for paths in nbest_viterbi(lines, nbest, trigram)]
+    elif batch_size:
+        results = batch_viterbi(lines, trigram, beam, batch_size)
+    else:
+        results = viterbi(lines, trigram, beam)
+    instrument_delta = instrument_stats - instrument_sent
+    instrument_sent = collections.Counter(instrument_stats)
+    return (results, cache_stats - before, instrument_delta)
+
+# Decode a single line, given as its emission table rows, with the
+#   requested decoder
+def decode_sentence(index, rows, trigram, beam):
+    # Prefer the trigram path when enabled, falling back to the bigram
+    #   decoder if it could not find a transition to terminate
+    if trigram:
+        with phase("recursion"):
+            (tri_best_final_pair, tri_back) = trigram_viterbi(index, rows, beam)
+        if tri_best_final_pair is not None:
+            with phase("backtrace"):
+                return trigram_backtrace(tri_best_final_pair, tri_back)
+
+    with phase("recursion"):
+        (bi_best_final_state, bi_back) = bigram_viterbi(index, rows, beam)
+    # Backtrace from the best_final_state
+    if bi_best_final_state is not None:
+        with phase("backtrace"):
+            return backtrace(bi_best_final_state, bi_back)
+    # If no best_final_state e.g. could not find transition to terminate
+    # then return empty string
+    return ""
+
+# Read HMM transition and emission probabilities into the module tables
+# Called once in the main process, or once per worker as the pool initializer
+# Files written by compile_hmm.py are memory-mapped instead of parsed
+def load_model(hmm_file):
+    with open(hmm_file, "rb") as f:
+        compiled = f.read(len(COMPILED_MAGIC)) == COMPILED_MAGIC
+
+    if compiled:
+        with phase("map_compiled_model"):
+            load_compiled_model(hmm_file)
+    else:
+        with phase("parse_model"):
+            load_text_model(hmm_file)
+        with phase("compile_model"):
+            compile_model()
+
+# Pool initializer: load the model, size the sentence cache and turn on
+#   instrumentation if the main process has it on
+# A forked worker starts from a copy of the main process's instrumentation,
+#   which is cleared so only the worker's own is sent back
+def init_worker(hmm_file, cache_size, instrument=False):
+    global sentence_cache_size, instrumented
+    sentence_cache_size = cache_size
+    instrumented = instrument
+    instrument_stats.clear()
+    instrument_sent.clear()
+    load_model(hmm_file)
+
+# Parse a text HMM file into the bitransition, emission, tritransition and
+#   uniform dicts
+def load_text_model(hmm_file):
+    global norm_a, norm_b, norm_c, suffix_theta, suffix_length
+
+    with open(hmm_file, "r") as f:
         for line in f:
             line = line.split()
 
@@ -304,9 +1199,10 @@ def main():
             # Read in states as state -> word
             elif line[0] == EMISSION_TAG:
                 (state, word, emit_prob) = line[1:4]
-                emission[state][word] = math.log(float(emit_prob))
+                emission_words.append(vocab.setdefault(word, len(vocab)))
+                emission_tags.append(sys.intern(state))
+                emission_probs.append(math.log(float(emit_prob)))
                 states.add(state)
-                vocab.add(word)
 
             elif line[0] == TRIGRAM_TRANSITION_TAG:
                 (prev_prev_state, prev_state, state, trans_prob) = line[1:5]
@@ -315,39 +1211,273 @@ def main():
                 states.add(prev_state)
                 states.add(state)
             elif line[0] == NORM_TAG:
-                (norm_a, norm_b, norm_c) = line[1:4]
+                (norm_a, norm_b, norm_c) = map(float, line[1:4])
             elif line[0] == UNIGRAM_TAG:
                 (state, state_prob) = line[1:3]
                 uniform[state] = math.log(float(state_prob))
+            elif line[0] == SUFFIX_TAG:
+                (signature, state, prob) = line[1:4]
+                suffix_signatures.append(signature)
+                suffix_tags.append(sys.intern(state))
+                suffix_probs.append(float(prob))
+            elif line[0] == SUFFIX_NORM_TAG:
+                suffix_theta = float(line[1])
+                suffix_length = int(line[2])
+
+# Split lines into contiguous chunks and decode them on a process pool
+# Each worker loads the model itself through the pool initializer, so only
+#   the chunks of text (and not the model tables) are pickled
+# imap hands back results in input order
+# Cache counters and instrumentation from the workers are added to this
+#   process's cache_stats and instrument_stats
+def parallel_viterbi(hmm_file, lines, workers, trigram=False, beam=None, cache_size=SENTENCE_CACHE_SIZE,
+        batch_size=None, nbest=None, nbest_format="jsonl"):
+    chunk_size = max(1, -(-len(lines) // (workers * CHUNKS_PER_WORKER)))
+    chunks = [lines[i:i + chunk_size] for i in range(0, len(lines), chunk_size)]
+    decode = functools.partial(viterbi_chunk, trigram=trigram, beam=beam, batch_size=batch_size,
+        nbest=nbest, nbest_format=nbest_format)
+    results = []
+    with multiprocessing.Pool(workers, initializer=init_worker,
+            initargs=(hmm_file, cache_size, instrumented)) as pool:
+        for (chunk_results, chunk_stats, chunk_instrument) in pool.imap(decode, chunks):
+            results.extend(chunk_results)
+            cache_stats.update(chunk_stats)
+            instrument_stats.update(chunk_instrument)
+    return results
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Tag text with an HMM.")
+    parser.add_argument("hmm_file")
+    parser.add_argument("text_file")
+    parser.add_argument("output_file")
+    parser.add_argument("--workers", type=int, default=1,
+        help="number of decoding processes (default: 1)")
+    parser.add_argument("--trigram", action="store_true",
+        help="decode with the interpolated trigram model")
+    parser.add_argument("--beam", type=int, default=None, metavar="K",
+        help="beam search keeping the K best states (or state pairs) per word")
+    parser.add_argument("--compare-exact", action="store_true",
+        help="with --beam, also decode exactly and report how often they differ")
+    parser.add_argument("--batch-size", type=int, default=None, metavar="N",
+        help="decode N sentences of similar length at a time with batch_viterbi")
+    parser.add_argument("--stream", action="store_true",
+        help="read and tag the input lazily, writing each line as it is decoded")
+    parser.add_argument("--cache-size", type=int, default=SENTENCE_CACHE_SIZE, metavar="N",
+        help="decoded sentences to keep in the LRU cache, 0 to disable (default: {})"
+            .format(SENTENCE_CACHE_SIZE))
+    parser.add_argument("--instrument", default=os.environ.get(INSTRUMENT_ENV), metavar="FILE",
+        help="record phase times, counters and sentence latencies and write them as JSON to FILE "
+            "(default: ${})".format(INSTRUMENT_ENV))
+    parser.add_argument("--profile", default=os.environ.get(PROFILE_ENV), metavar="FILE",
+        help="run under cProfile and write the statistics to FILE (default: ${})".format(PROFILE_ENV))
+    parser.add_argument("--nbest", type=int, default=None, metavar="N",
+        help="write the N best tag sequences of each line with their log probabilities")
+    parser.add_argument("--nbest-format", choices=["jsonl", "tsv"], default="jsonl",
+        help="n-best output format (default: jsonl)")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.beam is not None and args.beam < 1:
+        parser.error("--beam must be at least 1")
+    if args.batch_size is not None and args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.stream and args.compare_exact:
+        parser.error("--compare-exact needs the whole input and cannot be used with --stream")
+    if args.nbest is not None and args.nbest < 1:
+        parser.error("--nbest must be at least 1")
+    if args.nbest is not None and (args.beam is not None or args.batch_size is not None):
+        parser.error("--nbest decodes exactly, one sentence at a time, and cannot be used with --beam or --batch-size")
+    return args
+
+# Decode lines in this process or on a pool as requested on the command line
+def decode(args, lines, beam):
+    if args.workers > 1:
+        return parallel_viterbi(args.hmm_file, lines, args.workers, args.trigram, beam, args.cache_size,
+            args.batch_size, args.nbest, args.nbest_format)
+    return viterbi_chunk(lines, args.trigram, beam, args.batch_size, args.nbest, args.nbest_format)[0]
+
+# Print how often beam search and exact Viterbi disagree, by sentence and
+#   by token, so the beam width can be chosen with the error rate in view
+def compare_exact(args, lines, results, beam_time, info):
+    t0 = time.time()
+    exact = decode(args, lines, None)
+    t1 = time.time()
+
+    num_sentence_diffs = num_token_diffs = num_tokens = 0
+    for (beam_sequence, exact_sequence) in zip(results, exact):
+        exact_tags = exact_sequence.split()
+        token_diffs = sum(1 for (a, b) in itertools.zip_longest(beam_sequence.split(), exact_tags) if a != b)
+        num_tokens += len(exact_tags)
+        num_token_diffs += token_diffs
+        num_sentence_diffs += token_diffs > 0
+
+    print("Beam {} differs from exact Viterbi on {} of {} sentences ({} of {} tokens)"
+        .format(args.beam, num_sentence_diffs, len(lines), num_token_diffs, num_tokens), file=info)
+    print("Decoding time with beam: {} exact: {}".format(beam_time, t1 - t0), file=info)
+
+# Decode lines lazily from an iterable, yielding tag lines in input order
+# Without workers each line is decoded as soon as it is read, or each
+#   batch of --batch-size lines; with workers lines are grouped into
+#   chunks of STREAM_CHUNK_SIZE (or --batch-size) and at most
+#   workers * CHUNKS_PER_WORKER chunks are in flight, so memory stays
+#   bounded however long the input is
+def stream_viterbi(args, lines):
+    if args.workers == 1 and args.nbest:
+        for line in lines:
+            yield format_nbest(nbest_viterbi([line], args.nbest, args.trigram)[0], args.nbest_format)
+        return
+    if args.workers == 1 and not args.batch_size:
+        for line in lines:
+            yield viterbi([line], args.trigram, args.beam)[0]
+        return
+
+    chunks = iter(lambda: list(itertools.islice(lines, args.batch_size or STREAM_CHUNK_SIZE)), [])
+    if args.workers == 1:
+        for chunk in chunks:
+            yield from batch_viterbi(chunk, args.trigram, args.beam, args.batch_size)
+        return
 
+    decode = functools.partial(viterbi_chunk, trigram=args.trigram, beam=args.beam, batch_size=args.batch_size,
+        nbest=args.nbest, nbest_format=args.nbest_format)
+    with multiprocessing.Pool(args.workers, initializer=init_worker,
+            initargs=(args.hmm_file, args.cache_size, instrumented)) as pool:
+        pending = collections.deque()
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is not None:
+                pending.append(pool.apply_async(decode, (chunk,)))
+            # Wait for the oldest chunk once the window is full, and for
+            #   every remaining chunk at the end of the input
+            while pending and (chunk is None or len(pending) >= args.workers * CHUNKS_PER_WORKER):
+                (chunk_results, chunk_stats, chunk_instrument) = pending.popleft().get()
+                cache_stats.update(chunk_stats)
+                instrument_stats.update(chunk_instrument)
+                yield from chunk_results
 
-    # Create the set of all state pairs
-    non_initial_states = states - set(INIT_STATE)
-    non_initial_state_pairs = set([p for p in itertools.product(non_initial_states, repeat=2)])
-    union_with = set([(INIT_STATE, state) for state in non_initial_states]) | non_initial_state_pairs
-    state_pairs.update(union_with)
-    state_pairs.add((INIT_STATE, INIT_STATE))
+# Open a text file, with "-" standing for stdin or stdout
+def open_text(path, mode):
+    if path == "-":
+        return contextlib.nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    return open(path, mode)
+
+# Print info to stdout (or stderr when the tags went to stdout)
+def print_report(num_lines, elapsed, info):
+    print("Processed {} lines".format(num_lines), file=info)
+    print("Time taken to run: {}".format(elapsed), file=info)
+    print("Sentence cache: {} hits, {} misses".format(
+        cache_stats["sentence_hits"], cache_stats["sentence_misses"]), file=info)
+    print("Word cache: {} hits, {} misses".format(
+        cache_stats["word_hits"], cache_stats["word_misses"]), file=info)
+
+# Write the instrumentation collected over the run as a JSON report
+def write_instrument_report(path, elapsed):
+    def section(prefix):
+        return {key[len(prefix):]: value for (key, value) in sorted(instrument_stats.items())
+            if key.startswith(prefix)}
+
+    counters = section("count.")
+    phases = section("time.")
+    latency = sorted((int(bucket), n) for (bucket, n) in section("latency.").items())
+    decode_time = phases.get("decode", 0.0)
+    report = {
+        "argv": sys.argv,
+        "wall_s": elapsed,
+        "phases_s": phases,
+        "counters": counters,
+        "tokens_per_s": counters.get("tokens", 0) / decode_time if decode_time else 0.0,
+        "oov_rate": counters.get("oov_tokens", 0) / counters["tokens"] if counters.get("tokens") else 0.0,
+        "sentence_latency_us": {"<{}".format(bucket): n for (bucket, n) in latency},
+        "cache": dict(cache_stats),
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=1)
+
+# Main method: run the tagger, under cProfile if asked, and write the
+#   instrumentation report at exit even if the run fails
+def main():
+    global instrumented
+
+    args = parse_args()
+    instrumented = args.instrument is not None
+
+    t0 = time.time()
+    try:
+        if args.profile is not None:
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(run, args)
+            finally:
+                profiler.dump_stats(args.profile)
+        else:
+            run(args)
+    finally:
+        if instrumented:
+            write_instrument_report(args.instrument, time.time() - t0)
+
+# Tag the text as the command line asks
+def run(args):
+    # Keep stdout clean for the tags when they are written there
+    info = sys.stderr if args.output_file == "-" else sys.stdout
+
+    # Mark start time
+    t0 = time.time()
+
+    # A corpus cache is mapped onto the model's word indices in this process,
+    #   so the model is loaded here even when workers decode, and it is
+    #   decoded in batches unless --batch-size says otherwise
+    cached = args.text_file != "-" and corpus_cache.is_corpus(args.text_file)
+    if args.workers == 1 or cached:
+        init_worker(args.hmm_file, args.cache_size, instrumented)
+    if cached and args.batch_size is None and args.nbest is None:
+        args.batch_size = BATCH_SIZE
+
+    if args.stream:
+        num_lines = 0
+        with contextlib.ExitStack() as stack:
+            if cached:
+                text_file = iter(corpus_sentences(args.text_file))
+            else:
+                text_file = stack.enter_context(open_text(args.text_file, "r"))
+            output_file = stack.enter_context(open_text(args.output_file, "w"))
+            lines = timed_iter("read_input", text_file)
+            for sequence in timed_iter("decode", stream_viterbi(args, lines)):
+                with phase("write_output"):
+                    output_file.write(sequence + "\n")
+                num_lines += 1
+
+        # Input is read while the decoder is being waited on, so take it
+        #   out of the decode time
+        if instrumented:
+            instrument_stats["time.decode"] -= instrument_stats["time.read_input"]
+
+        print_report(num_lines, time.time() - t0, info)
+        return
 
     # Read lines from text file and then split by number of processes
     text_file_lines = []
-    with open(TEXT_FILE, "r") as f:
-        text_file_lines = f.readlines()
+    with phase("read_input"):
+        if cached:
+            text_file_lines = corpus_sentences(args.text_file)
+        else:
+            with open_text(args.text_file, "r") as f:
+                text_file_lines = f.readlines()
 
-    results = viterbi(text_file_lines)
+    decode_start = time.time()
+    with phase("decode"):
+        results = decode(args, text_file_lines, args.beam)
+    decode_time = time.time() - decode_start
 
     # Print output to file
-    with open(OUTPUT_FILE, "w") as f:
-        for lines in results:
-            for line in lines:
-                f.write(line)
-            f.write("\n")
+    with phase("write_output"), open_text(args.output_file, "w") as f:
+        for line in results:
+            f.write(line + "\n")
 
     # Mark end time
     t1 = time.time()
 
-    # Print info to stdout
-    print("Processed {} lines".format(len(text_file_lines)))
-    print("Time taken to run: {}".format(t1 - t0))
+    print_report(len(text_file_lines), t1 - t0, info)
+
+    if args.beam is not None and args.compare_exact:
+        compare_exact(args, text_file_lines, results, decode_time, info)
 
 if __name__ == "__main__":    
     main()
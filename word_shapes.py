@@ -0,0 +1,28 @@
+"""
+Word Shapes
+
+Word shapes and suffix signatures for the suffix model of unknown words.
+train_hmm.py estimates a tag distribution per signature from the rare
+words, and viterbi.py looks unseen words up by the same signatures, so
+both import them from here.
+
+"""
+
+ALL_RARE = "*"   # signature shared by all rare words
+
+# Shape class of a word: capitalized or not, with or without digits and
+#   hyphens, which sets e.g. proper nouns and numbers apart
+def word_shape(word):
+    shape = "C" if word[:1].isupper() else "c"
+    if any(character.isdigit() for character in word):
+        shape += "d"
+    if "-" in word:
+        shape += "h"
+    return shape
+
+# Signatures of a word for the suffix model, least specific first: its
+#   shape, then its shape with each suffix of up to max_suffix characters
+#   (never the whole word)
+def word_signatures(word, max_suffix):
+    shape = word_shape(word)
+    return [shape] + ["{}:{}".format(shape, word[-k:]) for k in range(1, min(max_suffix, len(word) - 1) + 1)]